@@ -0,0 +1,25 @@
+'use strict';
+
+const { execSync } = require('child_process');
+
+// Precompiles the Jinja templates into compiled_templates/ before the
+// deployment artifact is built, so that every deploy ships them.
+class CompileTemplates {
+  constructor(serverless) {
+    this.serverless = serverless;
+    this.hooks = {
+      'before:package:createDeploymentArtifacts': this.compile.bind(this),
+    };
+  }
+
+  compile() {
+    this.serverless.cli.log('Compiling templates...');
+    execSync('pipenv run flask compile-templates', {
+      cwd: this.serverless.config.servicePath,
+      env: Object.assign({}, process.env, { FLASK_APP: 'gainesvilletips_org.py' }),
+      stdio: 'inherit',
+    });
+  }
+}
+
+module.exports = CompileTemplates;
@@ -0,0 +1,66 @@
+"""
+Shared helpers for the benchmark scripts.
+
+The scripts are meant to be run from the repo root, e.g.:
+
+    pipenv run python benchmarks/search.py
+"""
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# Creating the boto3 clients requires a region, even though the benchmarks
+# never talk to AWS.
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import gainesvilletips_org as site  # noqa: E402
+
+
+first_names = ['Bob', 'Linda', 'Tina', 'Gene', 'Louise', 'Jimmy', 'Teddy',
+               'Harry', 'Karrin', 'Kevin', 'Sponge', 'Patrick', 'Sandy',
+               'Scooby', 'Shaggy', 'Velma', 'Daphne', 'Fred', 'Marge', 'Moe']
+last_names = ['Belcher', 'Pesto', 'Dresden', 'Murphy', 'Carpenter', 'Doo',
+              'Rogers', 'Dinkley', 'Blake', 'Jones', 'Szyslak', 'Simpson',
+              'Squarepants', 'Star', 'Cheeks', 'Krabs', 'Plankton']
+venues = ["Bob's Burgers", "Jimmy Pesto's Pizzeria", "McAnally's Pub",
+          'The Krusty Krab', 'The Chum Bucket', "Moe's Tavern", 'The Van',
+          "Satchel's", 'Midtown', 'The Top', 'Swamp Head Brewery',
+          'Cymplify Brewing', 'The Bull', 'Loosey\'s', 'Civilization']
+positions = ['Server', 'Bartender', 'Cook', 'Host', 'Barback', 'Busser',
+             'Dishwasher', 'Promoter', 'Security', 'Manager']
+
+
+def make_records(count, seed=0, moderated_ratio=0.9):
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        record = site.Record()
+        record.id = f'bench-{i}'
+        record.moderated = rng.random() < moderated_ratio
+        record.timestamp = f'2020-04-{1 + i % 28:02}T12:00:00'
+        first = rng.choice(first_names)
+        record.name = f'{first} {rng.choice(last_names)}'
+        record.email = f'{first.lower()}{i}@example.com'
+        record.venue = rng.choice(venues)
+        record.position = rng.choice(positions)
+        record.cash_app = f'${first.lower()}{i}'
+        record.venmo = f'@{first.lower()}{i}'
+        record.paypal = f'{first.lower()}{i}@example.com'
+        record.photo = f'{site.photo_bucket_url}bench-{i}.jpg'
+        record.thumbnail = f'{site.photo_bucket_url}bench-{i}-thumb.jpg'
+        records.append(record)
+    return records
+
+
+def timed(func, *args, repeat=1, **kwargs):
+    """
+    Call func repeat times and return its last result with the mean duration.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*args, **kwargs)
+    return result, (time.perf_counter() - start) / repeat
@@ -0,0 +1,503 @@
+"""
+In-memory stand-ins for the AWS and Google API clients, for benchmarking
+without AWS or Google access.
+
+Only the parts of the client APIs that the site uses are implemented.  Each
+call sleeps for a simulated round trip, proportional to the size of the
+response, so that concurrency shows up in the timings the way it would
+against the real services.
+"""
+import io
+import json
+import random
+import re
+import threading
+import time
+import zlib
+
+from botocore.exceptions import ClientError
+
+
+class FakeDynamoDB:
+    # Hash and range keys of the secondary indexes in serverless.yml.
+    indexes = {
+        'pending-index': ('pending', 'name_key'),
+        'venue-index': ('venue_key', 'name_key'),
+    }
+
+    def __init__(self, latency=0.005, bytes_per_second=20e6,
+                 page_bytes=1024 * 1024, unprocessed_rate=0.0):
+        self.tables = {}
+        # Fraction of batch write requests to hand back as unprocessed, to
+        # exercise the retry handling.
+        self.unprocessed_rate = unprocessed_rate
+        self.sizes = {}
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.page_bytes = page_bytes
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _table(self, name):
+        return self.tables.setdefault(name, {})
+
+    def _call(self, operation, response_bytes=0):
+        with self.lock:
+            self.calls.append(operation)
+        time.sleep(self.latency + response_bytes / self.bytes_per_second)
+
+    @staticmethod
+    def _size(item):
+        return len(json.dumps(item))
+
+    @staticmethod
+    def _project(item, projection, names):
+        if not projection:
+            return dict(item)
+        fields = [names.get(name.strip(), name.strip())
+                  for name in projection.split(',')]
+        return {field: item[field] for field in fields if field in item}
+
+    def get_item(self, TableName, Key, ProjectionExpression=None,
+                 ExpressionAttributeNames=None, ConsistentRead=False):
+        item = self._table(TableName).get(Key['id']['S'])
+        if item is None:
+            self._call('get_item')
+            return {}
+        item = self._project(item, ProjectionExpression,
+                             ExpressionAttributeNames or {})
+        self._call('get_item', self._size(item))
+        return {'Item': item}
+
+    def put_item(self, TableName, Item):
+        self._call('put_item')
+        self._table(TableName)[Item['id']['S']] = dict(Item)
+        self.sizes.pop((TableName, Item['id']['S']), None)
+        return {}
+
+    def _item_size(self, table_name, key):
+        # Sizing items is the slowest part of a fake scan, so cache it.
+        size = self.sizes.get((table_name, key))
+        if size is None:
+            size = self.sizes[(table_name, key)] = self._size(
+                self._table(table_name)[key])
+        return size
+
+    def delete_item(self, TableName, Key):
+        self._call('delete_item')
+        self._table(TableName).pop(Key['id']['S'], None)
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression,
+                    ConditionExpression=None,
+                    ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None,
+                    ReturnValues='NONE'):
+        self._call('update_item')
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        with self.lock:
+            table = self._table(TableName)
+            self._check_condition(table.get(Key['id']['S']),
+                                  ConditionExpression, names, values)
+            item = table.setdefault(Key['id']['S'], dict(Key))
+            before = dict(item)
+            self.sizes.pop((TableName, Key['id']['S']), None)
+            updated = self._apply_update(item, UpdateExpression, names,
+                                         values)
+        if ReturnValues == 'ALL_OLD':
+            return {'Attributes': before} if len(before) > 1 else {}
+        if ReturnValues == 'UPDATED_OLD':
+            return {'Attributes': {field: before[field] for field in updated
+                                   if field in before}}
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': dict(item)}
+        if ReturnValues == 'UPDATED_NEW':
+            return {'Attributes': {field: item[field] for field in updated
+                                   if field in item}}
+        return {}
+
+    @staticmethod
+    def _check_condition(item, expression, names, values):
+        # Only the simple conditions used by the site are supported: ANDed
+        # attribute_exists, attribute_not_exists, contains and equality
+        # checks.
+        if not expression:
+            return
+        for term in expression.split(' AND '):
+            match = re.fullmatch(r'(NOT )?(attribute_exists|'
+                                 r'attribute_not_exists|contains)'
+                                 r'\((\S+?)(?:, (:\w+))?\)', term.strip())
+            if match is None:
+                match = re.fullmatch(r'()(\S+) = (:\w+)', term.strip())
+                if match is None:
+                    raise NotImplementedError(expression)
+                negate, name, value = match.groups()
+                function = '='
+            else:
+                negate, function, name, value = match.groups()
+            field = names.get(name, name)
+            present = item is not None and field in item
+            if function == '=':
+                result = present and item[field] == values[value]
+            elif function == 'attribute_exists':
+                result = present
+            elif function == 'attribute_not_exists':
+                result = not present
+            else:
+                needle = values[value]['S']
+                result = present and needle in list(item[field].values())[0]
+            if bool(negate) == result:
+                raise ClientError({'Error': {
+                    'Code': 'ConditionalCheckFailedException',
+                }}, 'UpdateItem')
+
+    @staticmethod
+    def _apply_update(item, expression, names, values):
+        updated = []
+        clauses = re.split(r'\b(SET|ADD|REMOVE|DELETE)\b', expression)
+        for action, clause in zip(clauses[1::2], clauses[2::2]):
+            for part in clause.split(','):
+                part = part.strip()
+                if not part:
+                    continue
+                if action == 'SET':
+                    name, value = [p.strip() for p in part.split('=')]
+                    field = names.get(name, name)
+                    item[field] = values[value]
+                elif action == 'REMOVE':
+                    field = names.get(part, part)
+                    item.pop(field, None)
+                else:
+                    name, value = part.split()
+                    field = names.get(name, name)
+                    value = values[value]
+                    if 'N' in value:
+                        current = int(item.get(field, {'N': '0'})['N'])
+                        item[field] = {'N': str(current + int(value['N']))}
+                    elif action == 'ADD':
+                        current = set(item.get(field, {'SS': []})['SS'])
+                        item[field] = {'SS': sorted(current |
+                                                    set(value['SS']))}
+                    else:
+                        current = set(item.get(field, {'SS': []})['SS'])
+                        remaining = sorted(current - set(value['SS']))
+                        if remaining:
+                            item[field] = {'SS': remaining}
+                        else:
+                            item.pop(field, None)
+                updated.append(field)
+        return updated
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        size = 0
+        for table_name, request in RequestItems.items():
+            assert len(request['Keys']) <= 100, 'too many keys in batch'
+            table = self._table(table_name)
+            for key in request['Keys']:
+                item = table.get(key['id']['S'])
+                if item is None:
+                    continue
+                item = self._project(item,
+                                     request.get('ProjectionExpression'),
+                                     request.get('ExpressionAttributeNames',
+                                                 {}))
+                size += self._size(item)
+                responses.setdefault(table_name, []).append(item)
+        self._call('batch_get_item', size)
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems):
+        unprocessed = {}
+        for table_name, requests in RequestItems.items():
+            assert len(requests) <= 25, 'too many items in batch'
+            size = 0
+            for request in requests:
+                if random.random() < self.unprocessed_rate:
+                    unprocessed.setdefault(table_name, []).append(request)
+                elif 'PutRequest' in request:
+                    item = request['PutRequest']['Item']
+                    self._table(table_name)[item['id']['S']] = dict(item)
+                    self.sizes.pop((table_name, item['id']['S']), None)
+                    size += self._size(item)
+                else:
+                    key = request['DeleteRequest']['Key']['id']['S']
+                    self._table(table_name).pop(key, None)
+        self._call('batch_write_item', size)
+        return {'UnprocessedItems': unprocessed}
+
+    def transact_write_items(self, TransactItems):
+        # Only puts, updates and deletes are supported.  Every condition is
+        # checked before anything is written, so a cancelled transaction
+        # changes nothing.
+        assert len(TransactItems) <= 25, 'too many items in transaction'
+        self._call('transact_write_items')
+        with self.lock:
+            reasons = []
+            for request in TransactItems:
+                update = (request.get('Update') or request.get('Delete') or
+                          request['Put'])
+                key = update['Key'] if 'Key' in update else update['Item']
+                try:
+                    self._check_condition(
+                        self._table(update['TableName']).get(key['id']['S']),
+                        update.get('ConditionExpression'),
+                        update.get('ExpressionAttributeNames', {}),
+                        update.get('ExpressionAttributeValues', {}))
+                    reasons.append({'Code': 'None'})
+                except ClientError:
+                    reasons.append({'Code': 'ConditionalCheckFailed'})
+            if any(reason['Code'] != 'None' for reason in reasons):
+                raise ClientError({
+                    'Error': {'Code': 'TransactionCanceledException'},
+                    'CancellationReasons': reasons,
+                }, 'TransactWriteItems')
+            for request in TransactItems:
+                if 'Put' in request:
+                    put = request['Put']
+                    key = put['Item']['id']['S']
+                    self.sizes.pop((put['TableName'], key), None)
+                    self._table(put['TableName'])[key] = dict(put['Item'])
+                    continue
+                update = request.get('Update') or request['Delete']
+                key = update['Key']['id']['S']
+                self.sizes.pop((update['TableName'], key), None)
+                if 'Delete' in request:
+                    self._table(update['TableName']).pop(key, None)
+                    continue
+                item = self._table(update['TableName']).setdefault(
+                    key, dict(update['Key']))
+                self._apply_update(
+                    item, update['UpdateExpression'],
+                    update.get('ExpressionAttributeNames', {}),
+                    update.get('ExpressionAttributeValues', {}))
+        return {}
+
+    def query(self, TableName, IndexName, KeyConditionExpression,
+              ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+              ProjectionExpression=None, ExclusiveStartKey=None):
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        name, value = [part.strip()
+                       for part in KeyConditionExpression.split('=')]
+        hash_key, range_key = self.indexes[IndexName]
+        assert names.get(name, name) == hash_key, 'not the index hash key'
+        value = values[value]
+        matches = sorted(
+            (item for item in self._table(TableName).values()
+             if item.get(hash_key) == value and range_key in item),
+            key=lambda item: (item[range_key]['S'], item['id']['S']))
+        if ExclusiveStartKey is not None:
+            start = (ExclusiveStartKey[range_key]['S'],
+                     ExclusiveStartKey['id']['S'])
+            matches = [item for item in matches
+                       if (item[range_key]['S'], item['id']['S']) > start]
+        items = []
+        size = 0
+        result = {}
+        for item in matches:
+            size += self._size(item)
+            items.append(self._project(item, ProjectionExpression, names))
+            if size >= self.page_bytes:
+                result['LastEvaluatedKey'] = {
+                    'id': item['id'],
+                    hash_key: item[hash_key],
+                    range_key: item[range_key],
+                }
+                break
+        self._call('query', size)
+        result['Items'] = items
+        result['Count'] = len(items)
+        return result
+
+    def scan(self, TableName, ProjectionExpression=None,
+             ExpressionAttributeNames=None, Segment=0, TotalSegments=1,
+             ExclusiveStartKey=None):
+        keys = sorted(key for key in self._table(TableName)
+                      if zlib.crc32(key.encode()) % TotalSegments == Segment)
+        if ExclusiveStartKey is not None:
+            start = ExclusiveStartKey['id']['S']
+            keys = [key for key in keys if key > start]
+        items = []
+        size = 0
+        result = {}
+        table = self._table(TableName)
+        for key in keys:
+            # Like DynamoDB, the page limit applies to the size of the items
+            # read, not to the projected items returned.
+            item_size = self._item_size(TableName, key)
+            size += item_size
+            items.append(self._project(table[key], ProjectionExpression,
+                                       ExpressionAttributeNames or {}))
+            if size >= self.page_bytes:
+                result['LastEvaluatedKey'] = {'id': {'S': key}}
+                break
+        if ProjectionExpression:
+            size = sum(self._size(item) for item in items)
+        self._call('scan', size)
+        result['Items'] = items
+        result['Count'] = len(items)
+        return result
+
+
+class FakeS3:
+    def __init__(self, latency=0.02, bytes_per_second=10e6, keep_bodies=True):
+        self.objects = {}
+        # Without the bodies, only the sizes of uploaded objects are kept.
+        self.keep_bodies = keep_bodies
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _call(self, operation, request_bytes=0):
+        with self.lock:
+            self.calls.append(operation)
+        time.sleep(self.latency + request_bytes / self.bytes_per_second)
+
+    def upload_file(self, filename, bucket, key, ExtraArgs=None):
+        with open(filename, 'rb') as fh:
+            self.upload_fileobj(fh, bucket, key, ExtraArgs)
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None):
+        body = fileobj.read()
+        self._call('put_object', len(body))
+        if not self.keep_bodies:
+            body = FakeBody(len(body))
+        self.objects[(bucket, key)] = (body, dict(ExtraArgs or {}))
+
+    def head_object(self, Bucket, Key):
+        self._call('head_object')
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        body, extra = self.objects[(Bucket, Key)]
+        return {'ContentLength': len(body), **extra}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            self._call('get_object')
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        body, extra = self.objects[(Bucket, Key)]
+        assert self.keep_bodies, 'object bodies are not being kept'
+        self._call('get_object', len(body))
+        return {'ContentLength': len(body), 'Body': io.BytesIO(body),
+                **extra}
+
+    def delete_object(self, Bucket, Key):
+        self._call('delete_object')
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+
+class FakeBody:
+    def __init__(self, length):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+class FakeGoogleRequest:
+    """
+    A request built by a Google API service, which returns a canned response
+    when executed.
+    """
+    def __init__(self, api, operation, response, response_bytes=0):
+        self.api = api
+        self.operation = operation
+        self.response = response
+        self.response_bytes = response_bytes
+
+    def execute(self):
+        self.api._call(self.operation, self.response_bytes)
+        return self.response
+
+
+class FakeMediaRequest:
+    """
+    A media download request, as used by MediaIoBaseDownload, which fetches
+    byte ranges through its http attribute.
+    """
+    def __init__(self, api, uri, body):
+        self.uri = uri
+        self.headers = {}
+        self.http = FakeHttp(api, body)
+
+
+class FakeHttpResponse(dict):
+    def __init__(self, status, headers):
+        super().__init__(headers)
+        self.status = status
+
+
+class FakeHttp:
+    def __init__(self, api, body):
+        self.api = api
+        self.body = body
+
+    def request(self, uri, method='GET', headers=None, **kwargs):
+        start, end = re.fullmatch(r'bytes=(\d+)-(\d+)',
+                                  (headers or {})['range']).groups()
+        content = self.body[int(start):int(end) + 1]
+        self.api._call('get_media', len(content))
+        return FakeHttpResponse(206, {
+            'content-range': f'bytes {start}-{end}/{len(self.body)}',
+        }), content
+
+
+class FakeGoogleAPI:
+    def __init__(self, latency=0.05, bytes_per_second=10e6):
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _call(self, operation, response_bytes=0):
+        with self.lock:
+            self.calls.append(operation)
+        time.sleep(self.latency + response_bytes / self.bytes_per_second)
+
+
+class FakeSheets(FakeGoogleAPI):
+    """
+    The Sheets API, serving the given rows from any spreadsheet.
+    """
+    def __init__(self, rows, **kwargs):
+        super().__init__(**kwargs)
+        self.rows = rows
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId, range):
+        return FakeGoogleRequest(self, 'values.get', {'values': self.rows},
+                                 len(json.dumps(self.rows)))
+
+
+class FakeDrive(FakeGoogleAPI):
+    """
+    The Drive API, serving files added with add_file.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.files_by_id = {}
+
+    def add_file(self, file_id, body, mime_type='image/jpeg', version='1'):
+        self.files_by_id[file_id] = (body, mime_type, version)
+
+    def files(self):
+        return self
+
+    def get(self, fileId, fields=None):
+        body, mime_type, version = self.files_by_id[fileId]
+        return FakeGoogleRequest(self, 'files.get',
+                                 {'mimeType': mime_type, 'version': version})
+
+    def get_media(self, fileId):
+        body, mime_type, version = self.files_by_id[fileId]
+        return FakeMediaRequest(
+            self, f'https://www.googleapis.com/drive/v3/files/{fileId}', body)
@@ -0,0 +1,290 @@
+"""
+Load test the site's routes against in-memory stand-ins for AWS and Google.
+
+Seeds a fake servers table, spreadsheet and Drive folder with synthetic data
+and photos, then sends concurrent requests to each route in turn, reporting
+latency percentiles, throughput and peak memory.  The results can be saved
+as a baseline for later runs to be compared against, e.g.:
+
+    pipenv run python benchmarks/loadtest.py --save-baseline
+    (make changes)
+    pipenv run python benchmarks/loadtest.py
+
+Runs that are slower than the baseline by more than the tolerance exit with
+an error, so this can also be used to catch performance regressions.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+token = 'loadtest'
+# The admin token is read when the site is imported.
+os.environ['ADMIN_TOKEN'] = token
+os.environ['USE_DYNAMODB'] = 'true'
+
+from common import (  # noqa: E402
+    first_names,
+    last_names,
+    make_records,
+    positions,
+    site,
+    venues,
+)
+from fakes import FakeDrive, FakeDynamoDB, FakeS3, FakeSheets  # noqa: E402
+
+
+default_baseline = Path(__file__).resolve().parent / 'loadtest-baseline.json'
+queries = ['bob', 'belcher', 'krusty krab', 'bartnder', "moe's", 'dresden',
+           'swamp head', 'jimy pesto', 'security', 'civilisation']
+
+
+def make_photo(size):
+    # Gradients with some noise, so that the photo doesn't compress away to
+    # almost nothing, and is closer to a real one in size and in the work it
+    # takes to process.
+    image = Image.merge('RGB', [Image.linear_gradient('L').resize(size),
+                                Image.radial_gradient('L').resize(size),
+                                Image.effect_noise(size, 24)])
+    photo = io.BytesIO()
+    image.save(photo, 'JPEG', quality=90)
+    return photo.getvalue()
+
+
+def make_rows(count, photo_ratio, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        first = rng.choice(first_names)
+        photo = ''
+        if rng.random() < photo_ratio:
+            photo = f'https://drive.google.com/open?id=drive-{i}'
+        rows.append(['2020-04-01T12:00:00',
+                     f'{first} {rng.choice(last_names)}',
+                     f'{first.lower()}{i}@example.com', rng.choice(venues),
+                     rng.choice(positions), f'${first.lower()}{i}', '', '',
+                     photo])
+    return rows
+
+
+def setup(args):
+    db = FakeDynamoDB(latency=0)
+    for record in make_records(args.size):
+        db.put_item(TableName=site.table, Item=record.to_dynamodb())
+    db.latency = args.latency
+    site.db = db
+    # Only the sizes of uploaded photos are kept, so that they don't count
+    # towards the peak memory.
+    site.s3 = FakeS3(latency=args.latency * 4, keep_bodies=False)
+
+    photo = make_photo(tuple(args.photo_size))
+    rows = make_rows(args.rows, args.photo_ratio)
+    sheets = FakeSheets(rows, latency=args.latency * 10)
+    drive = FakeDrive(latency=args.latency * 10)
+    for row in rows:
+        if row[8]:
+            drive.add_file(row[8].split('id=')[1], photo)
+    apis = {'sheets': sheets, 'drive': drive}
+    site._gapi = lambda api_name, version: apis[api_name]
+    # The per request log lines would drown out the report.
+    site._timing_log.disabled = True
+    return photo
+
+
+def scenarios(photo):
+    def index(client, rng):
+        return client.get('/'), 200
+
+    def search(client, rng):
+        return client.get('/', query_string={'search': rng.choice(queries)}), \
+            200
+
+    def moderate(client, rng):
+        return client.get('/moderate', query_string={'token': token}), 200
+
+    def add_server(client, rng):
+        first = rng.choice(first_names)
+        return client.post('/add-server', data={
+            'name': f'{first} {rng.choice(last_names)}',
+            'email': f'{first.lower()}@example.com',
+            'venue': rng.choice(venues),
+            'position': rng.choice(positions),
+            'cash_app': f'${first.lower()}',
+            'venmo': '',
+            'paypal': '',
+            'photo': (io.BytesIO(photo), 'photo.jpg'),
+        }, content_type='multipart/form-data'), 303
+
+    def import_rows(client, rng):
+        return client.get('/import', query_string={'token': token}), 200
+
+    return {
+        '/': index,
+        '/?search=': search,
+        '/moderate': moderate,
+        '/add-server': add_server,
+        '/import': import_rows,
+    }
+
+
+def run(scenario, requests, concurrency, trace_memory):
+    latencies = []
+    errors = []
+    counter = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker(seed):
+        client = site.app.test_client()
+        rng = random.Random(seed)
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start = time.perf_counter()
+            response, expected_status = scenario(client, rng)
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                if response.status_code != expected_status:
+                    errors.append(response.status)
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker, seed)
+                       for seed in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        # Peak resident size of the whole process so far, in KB on Linux.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'throughput': len(latencies) / elapsed,
+        'peak_mb': peak / 1024 / 1024,
+    }
+
+
+def percentile(values, percent):
+    # Nearest rank, which works for however few requests were made.
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change from the baseline, returning whether any route got
+    slower by more than the tolerance.
+    """
+    regressed = False
+    print(f'\nCompared to baseline (tolerance {tolerance:.0%}):')
+    for route, result in results.items():
+        before = baseline['routes'].get(route)
+        if before is None:
+            continue
+        changes = []
+        for metric in ('p50', 'p95', 'p99', 'throughput'):
+            change = result[metric] / before[metric] - 1 \
+                if before[metric] else 0
+            # Lower is better for latency, higher for throughput.
+            worse = -change if metric == 'throughput' else change
+            flag = ''
+            if worse > tolerance:
+                flag = ' !'
+                regressed = True
+            changes.append(f'{metric} {change:+7.1%}{flag}')
+        print(f'  {route:<12} ' + '  '.join(changes))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--size', type=int, default=2000,
+                        help='number of records in the servers table')
+    parser.add_argument('--rows', type=int, default=100,
+                        help='number of rows in the spreadsheet')
+    parser.add_argument('--photo-ratio', type=float, default=0.5,
+                        help='fraction of spreadsheet rows with a photo')
+    parser.add_argument('--photo-size', type=int, nargs=2,
+                        default=[2000, 1500], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--requests', type=int, default=200,
+                        help='number of requests to send to each route')
+    parser.add_argument('--import-requests', type=int, default=3,
+                        help='number of requests to send to /import')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='simulated DynamoDB round trip, in seconds; '
+                             'the other services are slower')
+    parser.add_argument('--routes', nargs='+',
+                        help='only test these routes')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure peak Python memory per route with '
+                             'tracemalloc (slower), rather than peak RSS')
+    parser.add_argument('--baseline', type=Path, default=default_baseline)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction a metric can get worse by before it '
+                             'counts as a regression')
+    args = parser.parse_args()
+
+    photo = setup(args)
+    results = {}
+    print(f'{args.size} records, {args.rows} spreadsheet rows, '
+          f'concurrency {args.concurrency}')
+    memory = 'py peak' if args.trace_memory else 'peak rss'
+    print(f'  {"route":<12} {"requests":>8} {"errors":>6} {"p50":>9} '
+          f'{"p95":>9} {"p99":>9} {"req/s":>8} {memory:>9}')
+    for route, scenario in scenarios(photo).items():
+        if args.routes and route not in args.routes:
+            continue
+        requests = args.import_requests if route == '/import' \
+            else args.requests
+        result = results[route] = run(scenario, requests, args.concurrency,
+                                      args.trace_memory)
+        print(f'  {route:<12} {result["requests"]:>8} {result["errors"]:>6} '
+              f'{result["p50"]:>7.1f}ms {result["p95"]:>7.1f}ms '
+              f'{result["p99"]:>7.1f}ms {result["throughput"]:>8.1f} '
+              f'{result["peak_mb"]:>7.1f}MB')
+
+    params = {name: value for name, value in vars(args).items()
+              if name not in ('baseline', 'save_baseline', 'tolerance',
+                              'routes')}
+    params['photo_size'] = list(args.photo_size)
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(
+            {'params': params, 'routes': results}, indent=2))
+        print(f'\nSaved baseline to {args.baseline}')
+    elif args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+        if baseline['params'] != params:
+            print('\nWarning: the baseline was run with different options:')
+            print(f'  {baseline["params"]}')
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
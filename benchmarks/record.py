@@ -0,0 +1,120 @@
+"""
+Compare the slotted Record against the original dict based one.
+
+Times converting a table's worth of DynamoDB items to records and back, and
+serializing them for the page, and measures the memory the records take.
+"""
+import argparse
+import tracemalloc
+
+from flask import json
+
+from common import make_records, site, timed
+
+
+class LegacyRecord(dict):
+    """
+    The original Record, reduced to what the comparison needs.
+    """
+    fields = site.Record.fields
+    sync_fields = site.Record.sync_fields
+    index_fields = site.Record.index_fields
+
+    def __init__(self):
+        super().__init__({field: '' for field in self.fields})
+        self['moderated'] = False
+        self.drive_file_id = None
+        self.drive_version = None
+        self.sync_hash = None
+
+    def __getattr__(self, name):
+        if name not in self:
+            raise AttributeError(name)
+        return self[name]
+
+    def __setattr__(self, name, value):
+        if name in self:
+            self[name] = value
+        else:
+            super().__setattr__(name, value)
+
+    @classmethod
+    def from_dynamodb(cls, item):
+        self = cls()
+        for field, value in item.items():
+            if field in cls.index_fields:
+                continue
+            setattr(self, field, list(value.values())[0])
+        return self
+
+    def to_dynamodb(self):
+        item = {}
+        for field, value in self.items():
+            if not value:
+                continue
+            item_type = 'BOOL' if field == 'moderated' else 'S'
+            item[field] = {item_type: value}
+        for field in self.sync_fields:
+            value = getattr(self, field)
+            if value:
+                item[field] = {'S': value}
+        name_key = site._index_key(self.name)
+        venue_key = site._index_key(self.venue)
+        if name_key:
+            item['name_key'] = {'S': name_key}
+            if not self.moderated:
+                item['pending'] = {'S': '1'}
+        if venue_key:
+            item['venue_key'] = {'S': venue_key}
+        return item
+
+
+def legacy_from_items(items):
+    return [LegacyRecord.from_dynamodb(item) for item in items]
+
+
+def legacy_to_items(records):
+    return [record.to_dynamodb() for record in records]
+
+
+def dumps(records):
+    with site.app.app_context():
+        return json.dumps(records)
+
+
+def memory(func, *args):
+    tracemalloc.start()
+    result = func(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        items = site.Record.to_dynamodb_items(make_records(size))
+        print(f'{size} records')
+        for label, from_items, to_items in [
+                ('dict', legacy_from_items, legacy_to_items),
+                ('slots', site.Record.from_dynamodb_items,
+                 site.Record.to_dynamodb_items)]:
+            records, load = timed(from_items, items, repeat=args.repeat)
+            converted, save = timed(to_items, records, repeat=args.repeat)
+            assert converted == items, 'items changed by round trip'
+            body, dump = timed(dumps, records, repeat=args.repeat)
+            size_bytes = memory(from_items, items)
+            print(f'  {label:<5}: load {load * 1000:>8.1f}ms  '
+                  f'save {save * 1000:>8.1f}ms  '
+                  f'json {dump * 1000:>8.1f}ms  '
+                  f'memory {size_bytes / 1024 / 1024:>7.1f}MB')
+
+
+if __name__ == '__main__':
+    main()
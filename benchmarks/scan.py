@@ -0,0 +1,47 @@
+"""
+Check the paginated, parallel table scan against a fake DynamoDB.
+
+Loads a synthetic table of each size through _load_dynamodb_data with one
+and several segments, checking that every record comes back (the original
+single scan call stopped at the first 1MB page) and reporting the speedup.
+"""
+import argparse
+
+from common import make_records, site, timed
+from fakes import FakeDynamoDB
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--segments', type=int, nargs='+', default=[1, 4, 8])
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        db = FakeDynamoDB()
+        site.db = db
+        expected = {}
+        for record in make_records(size):
+            db.put_item(TableName=site.table, Item=record.to_dynamodb())
+            expected[record.id] = record.projected(site.Record.listing_fields)
+        print(f'{size} records')
+        for segments in args.segments:
+            site.scan_segments = segments
+            for fields, label in [(None, 'all fields'),
+                                  (site.Record.listing_fields, 'listing')]:
+                db.calls.clear()
+                records, duration = timed(site._load_dynamodb_data,
+                                          fields=fields)
+                loaded = {record.id: record for record in records}
+                assert loaded.keys() == expected.keys(), 'missing records'
+                if fields is not None:
+                    assert all(loaded[key] == expected[key]
+                               for key in expected), 'wrong projection'
+                print(f'  {segments} segment(s), {label:<10}: '
+                      f'{duration * 1000:>8.1f}ms '
+                      f'({db.calls.count("scan")} scan calls)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Compare the SearchIndex against the original extractBests search.
+
+Reports latency for each and how closely the results agree.  The original
+search scores the string form of the whole record (including the email and
+photo URLs), so an exhaustive search over just the searchable fields is also
+run to check that trigram candidate generation doesn't drop any matches.
+"""
+import argparse
+
+from fuzzywuzzy import fuzz, process, utils
+
+from common import make_records, site, timed
+
+
+queries = ['bob', 'belcher', 'krusty krab', 'bartnder', "moe's", 'dresden',
+           'swamp head', 'jimy pesto', 'security', 'civilisation']
+
+
+def legacy_search(search, data):
+    active = [record for record in data if record.moderated]
+    search_results = process.extractBests(search, active,
+                                          limit=None,
+                                          score_cutoff=60)
+    return [result[0] for result in search_results]
+
+
+def exhaustive_search(index, search):
+    query = utils.full_process(search)
+    return [index.records[i] for i, choice in enumerate(index.choices)
+            if fuzz.WRatio(query, choice, full_process=False) >= 60]
+
+
+def ids(records):
+    return {record.id for record in records}
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--legacy-limit', type=int, default=10000,
+                        help='Skip the original search above this many '
+                             'records, since it can take minutes per query')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        data = make_records(size)
+        index, build_time = timed(site.SearchIndex, data)
+        print(f'{size} records (index built in {build_time * 1000:.1f}ms)')
+        print(f'  {"query":<14} {"index":>10} {"legacy":>10} '
+              f'{"matches":>15} {"vs legacy":>10} {"vs fields":>10}')
+        for query in queries:
+            results, index_time = timed(index.search, query, repeat=3)
+            exhaustive = ids(exhaustive_search(index, query))
+            missed = len(exhaustive - ids(results))
+            if size <= args.legacy_limit:
+                legacy, legacy_time = timed(legacy_search, query, data)
+                legacy_ms = f'{legacy_time * 1000:.1f}ms'
+                matches = f'{len(results)}/{len(legacy)}'
+                overlap = f'{jaccard(ids(legacy), ids(results)):.2f}'
+            else:
+                legacy_ms = overlap = '-'
+                matches = f'{len(results)}/-'
+            print(f'  {query:<14} {index_time * 1000:>8.1f}ms '
+                  f'{legacy_ms:>10} {matches:>15} {overlap:>10} '
+                  f'{"missed " + str(missed) if missed else "same":>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Measure cold start costs: importing the site, and each route's first request.
+
+Every measurement runs in a fresh interpreter, so that nothing is already
+imported or cached.  First requests are made against the in-memory fakes
+rather than boto3 clients, so the time to create a real client (which the
+site defers until a request needs one) is reported separately.  Also lists
+which of the slow optional modules each step ended up importing.
+
+Compile the templates first to measure with them precompiled:
+
+    FLASK_APP=gainesvilletips_org.py pipenv run flask compile-templates
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+repo_dir = Path(__file__).resolve().parent.parent
+heavy_modules = ['boto3', 'googleapiclient', 'google.auth', 'fuzzywuzzy',
+                 'PIL']
+routes = ['/', '/?search=bob', '/form', '/api/random',
+          '/api/search?search=bob', '/moderate?token=bench']
+
+
+def child_import():
+    start = time.perf_counter()
+    import gainesvilletips_org  # noqa: F401
+    return {'seconds': time.perf_counter() - start}
+
+
+def child_client():
+    start = time.perf_counter()
+    import boto3
+    boto3.client('dynamodb')
+    return {'seconds': time.perf_counter() - start}
+
+
+def child_request(route, size):
+    from common import make_records, site
+    from fakes import FakeDynamoDB, FakeS3
+
+    site.db = FakeDynamoDB(latency=0)
+    site.s3 = FakeS3()
+    for record in make_records(size):
+        site.db.put_item(TableName=site.table, Item=record.to_dynamodb())
+    site.db.latency = FakeDynamoDB().latency
+    client = site.app.test_client()
+    start = time.perf_counter()
+    response = client.get(route)
+    seconds = time.perf_counter() - start
+    assert response.status_code == 200, response.status
+    return {'seconds': seconds}
+
+
+def run_child(*args):
+    env = dict(os.environ, AWS_DEFAULT_REGION='us-east-1',
+               ADMIN_TOKEN='bench', USE_DYNAMODB='true')
+    output = subprocess.run(
+        [sys.executable, __file__, '--child', *args], cwd=repo_dir, env=env,
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def report(label, runs):
+    times = [run['seconds'] * 1000 for run in runs]
+    loaded = ', '.join(runs[-1]['loaded']) or 'none'
+    print(f'{label:<24} median {statistics.median(times):>7.1f}ms  '
+          f'min {min(times):>7.1f}ms  (loaded: {loaded})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--size', type=int, default=1000,
+                        help='number of records in the fake table')
+    parser.add_argument('--child', nargs='+', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, str(repo_dir))
+        step, *step_args = args.child
+        if step == 'import':
+            result = child_import()
+        elif step == 'client':
+            result = child_client()
+        else:
+            result = child_request(step_args[0], int(step_args[1]))
+        result['loaded'] = [name for name in heavy_modules
+                            if name in sys.modules]
+        print(json.dumps(result))
+        return
+
+    compiled = (repo_dir / 'compiled_templates').exists()
+    print(f'Templates precompiled: {"yes" if compiled else "no"}')
+    report('import', [run_child('import') for _ in range(args.repeat)])
+    report('boto3 client', [run_child('client') for _ in range(args.repeat)])
+    for route in routes:
+        report(route, [run_child('request', route, str(args.size))
+                       for _ in range(args.repeat)])
+
+
+if __name__ == '__main__':
+    main()
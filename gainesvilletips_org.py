@@ -1,36 +1,158 @@
+import contextvars
 import functools
+import gzip
+import itertools
+import json
+import logging
 import mimetypes
 import os
 import pickle
+import queue
 import random
-from base64 import b64decode
-from datetime import datetime
-from operator import itemgetter
+import re
+import shutil
+import sys
+import threading
+import time
+from base64 import b64decode, urlsafe_b64decode, urlsafe_b64encode
+from collections import Counter, defaultdict, OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from hashlib import sha256
+from io import BytesIO
+from operator import attrgetter, itemgetter
 from pathlib import Path
+from tempfile import SpooledTemporaryFile
 from urllib.parse import urlparse, parse_qs
 from uuid import uuid4
 
-import boto3
+import click
 from botocore.exceptions import ClientError
-from flask import abort, Flask, redirect, render_template, request, url_for
+from flask import (
+    abort,
+    Flask,
+    g,
+    json as flask_json,
+    make_response,
+    redirect,
+    render_template,
+    request,
+    Request,
+    url_for,
+)
 from flask_httpauth import HTTPBasicAuth
-from fuzzywuzzy import process
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from jinja2 import Markup
-from PIL import Image
+from jinja2 import ChoiceLoader, escape, FileSystemLoader, Markup, ModuleLoader
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 app = Flask(__name__)
 app.debug = True
 auth = HTTPBasicAuth()
-db = boto3.client('dynamodb')
-s3 = boto3.client('s3')
 table = os.environ.get('SERVERS_TABLE', 'servers-table-dev')
 photo_bucket_name = os.environ.get('IMAGES_BUCKET', 'images-gainevilletipsorg')
 photo_bucket_url = f'https://{photo_bucket_name}.s3.amazonaws.com/'
 thumbnail_size = (88, 88)
+# Widths of the resized copies made of each photo, for the srcset, and the
+# formats they are encoded in as well as the photo's own.
+photo_widths = (176, 352, 704, 1408)
+photo_formats = [('WEBP', '.webp')]
+if os.environ.get('PHOTO_AVIF', 'false').lower() == 'true':
+    photo_formats.append(('AVIF', '.avif'))
+photo_encode_options = {
+    'JPEG': {'quality': 80, 'optimize': True, 'progressive': True},
+    'PNG': {'optimize': True},
+    'WEBP': {'quality': 75, 'method': 4},
+    'AVIF': {'quality': 60, 'speed': 6},
+}
+# Photos larger than this many bytes are buffered in a temp file rather than
+# in memory while they are processed.
+photo_memory_limit = int(os.environ.get('PHOTO_MEMORY_LIMIT',
+                                        str(20 * 1024 * 1024)))
+# Photos are stored under a hash of their contents, so an object's contents
+# never change and browsers and CDNs can cache them for good.
+photo_cache_control = 'public, max-age=31536000, immutable'
 admin_token = os.environ.get('ADMIN_TOKEN')
+# How long (in seconds) a warm container may serve records from memory before
+# checking the table again, and whether that check can be done by comparing
+# the data version on the meta item rather than rescanning the whole table.
+record_cache_ttl = float(os.environ.get('RECORD_CACHE_TTL', '300'))
+record_cache_conditional = os.environ.get('RECORD_CACHE_CONDITIONAL',
+                                          'true').lower() == 'true'
+# Items in the servers table with this ID prefix hold bookkeeping data rather
+# than server records.
+meta_prefix = '__'
+meta_id = f'{meta_prefix}meta__'
+# The IDs of the moderated records are kept in string sets spread over this
+# many items, so that no one item gets near DynamoDB's size limit and each
+# write to one only costs a fraction of the whole set.  Visit /reindex after
+# changing it.
+pool_shards = int(os.environ.get('POOL_SHARDS', '16'))
+pool_prefix = f'{meta_prefix}moderated-'
+# Secondary indexes of the records awaiting moderation and of venues.
+pending_index = 'pending-index'
+venue_index = 'venue-index'
+# Number of segments the table is split into for parallel scans.
+scan_segments = int(os.environ.get('SCAN_SEGMENTS', '4'))
+# Pre-fetched Google API discovery documents, so that building a client
+# doesn't need to fetch them, and how close to expiring the Google credentials
+# can get before they're refreshed.
+discovery_dir = Path(__file__).parent / 'discovery'
+gapi_refresh_margin = timedelta(minutes=5)
+# Number of photos to process at once during an import.
+import_workers = int(os.environ.get('IMPORT_WORKERS', '8'))
+# How photos submitted through the form are processed: 'sync' before the
+# submission returns, 'thread' by a pool of photo_workers background threads,
+# or 'queue' by the process-photos command.  The last two leave the uploads
+# in photo_queue_dir until they're processed, and records have no thumbnail
+# until then.
+photo_processing = os.environ.get('PHOTO_PROCESSING', 'sync').lower()
+photo_queue_dir = Path(os.environ.get('PHOTO_QUEUE_DIR', '/tmp/photo-queue'))
+photo_workers = int(os.environ.get('PHOTO_WORKERS', '2'))
+# Maximum numbers of items DynamoDB accepts in one batch_write_item,
+# batch_get_item and transact_write_items call.
+batch_write_size = 25
+batch_get_size = 100
+transact_write_size = 25
+# Page sizes for the JSON API, and the smallest response worth compressing.
+api_default_limit = 20
+api_max_limit = 100
+api_compress_min_size = 1024
+# How long (in seconds) a rendered public page is reused, how many are kept,
+# and how long browsers and CDNs may cache them for.  Pages are re-rendered
+# sooner if the data changes, but the random picks only change on re-render.
+page_cache_ttl = float(os.environ.get('PAGE_CACHE_TTL', '60'))
+page_cache_size = int(os.environ.get('PAGE_CACHE_SIZE', '256'))
+page_max_age = int(os.environ.get('PAGE_MAX_AGE', '60'))
+page_stale_while_revalidate = int(
+    os.environ.get('PAGE_STALE_WHILE_REVALIDATE', '600'))
+# Templates compiled to Python modules by the compile-templates command when
+# packaging, so that a cold start doesn't have to parse and compile them.
+compiled_templates_dir = Path(__file__).parent / 'compiled_templates'
+# Whether to time the stages and external calls of each request, for the
+# Server-Timing header and a JSON log line per request.  A fraction of
+# requests can also have their stacks sampled every profile_interval seconds,
+# to be collected from /profile.
+request_timing = os.environ.get('REQUEST_TIMING', 'true').lower() == 'true'
+profile_sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+profile_interval = float(os.environ.get('PROFILE_INTERVAL', '0.005'))
+# Snapshots of the moderated records (with their search index) and of the
+# public pages, exported to S3 so that reads can be served from there.  They
+# are exported by the export-snapshot command, and after every write to a
+# moderated record when SNAPSHOT_EXPORT is 'sync' (in the request that made
+# the write) or 'thread' (in the background).  Searches from the exported
+# pages go to search_url, which has to be set, since S3 can't search.
+snapshot_export = os.environ.get('SNAPSHOT_EXPORT', 'off').lower()
+snapshot_bucket_name = os.environ.get('SNAPSHOT_BUCKET', photo_bucket_name)
+snapshot_prefix = os.environ.get('SNAPSHOT_PREFIX', 'snapshot/')
+snapshot_search_url = os.environ.get('SNAPSHOT_SEARCH_URL', '')
+# Bumped whenever the layout of the exported data changes.
+snapshot_format = 1
 
 
 # @auth.verify_password
@@ -41,24 +163,41 @@ admin_token = os.environ.get('ADMIN_TOKEN')
 
 @app.route('/', methods=['GET'])
 def index():
-    is_added = 'added' in request.args
-    search = request.args.get('search', '')
-    if is_added:
+    if 'added' in request.args:
         search_results = _load_data(request.args['added'])
-        random_results = []
         if not search_results:
             abort(404)
-        search_results[0].thumbnail += f'?force-refresh={datetime.now()}'
+        response = make_response(_render_index('', search_results, [],
+                                               is_added=True))
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    search = ' '.join(request.args.get('search', '').split())
+    if search:
+        data = _load_data(fields=Record.listing_fields)
+        cache = _cache_for(data)
     else:
-        data = _load_data()
+        # Only random picks are needed, so the records don't have to be
+        # loaded at all.
+        data = []
+        cache = _moderated_pool()
+
+    def render():
         search_results = sorted(_do_search(search, data) if search else [],
                                 key=itemgetter('name'))
-        remaining = [record for record in data
-                     if record.moderated and record not in search_results]
-        random_results = random.sample(remaining, min(4, len(remaining)))
+        random_results = _random_records(
+            4, {record.id for record in search_results})
+        return _render_index(search, search_results, random_results)
 
-    return render_template('index.html', **{
-        'search': request.args.get('search', ''),
+    return _cached_page(('index', search), cache, render)
+
+
+def _render_index(search, search_results, random_results, is_added=False,
+                  search_url=''):
+    return _render_template('index.html', **{
+        'search': search,
+        'search_url': search_url,
         'is_added': is_added,
         'search_results': search_results,
         'moderation_results': [],
@@ -76,7 +215,7 @@ def index():
 
 @app.route('/form', methods=['GET'])
 def form():
-    return render_template('form.html', **{
+    return _render_template('form.html', **{
         'error': '',
         'form': {},
 
@@ -93,20 +232,30 @@ def form():
 @app.route('/add-server', methods=['POST'])
 def add_server():
     try:
-        if os.environ.get('USE_DYNAMODB', 'false').lower() != 'true':
+        if not _use_dynamodb():
             raise FormError('Cannot update spreadsheet')
         record = Record.from_request(request)
-        if _filename(request, 'photo'):
-            _save_form_photo(record)
-            _upload_photo(record)
-            _cleanup_photos(record)
+        job = None
+        photo_filename = _filename(request, 'photo')
+        if photo_filename:
+            photo = request.files['photo'].stream
+            suffix = Path(photo_filename).suffix
+            if photo_processing == 'sync':
+                _upload_photo(record, photo, suffix)
+            else:
+                job = _queue_photo(record, photo, suffix)
         try:
             db.put_item(TableName=table, Item=record.to_dynamodb())
         except ClientError as e:
+            if job is not None:
+                (photo_queue_dir / job['file']).unlink()
             raise FormError('Failed to save record') from e
+        _records_changed(created=[record])
+        if job is not None:
+            _submit_photo_job(job)
         return redirect(f'.?added={record.id}', code=303)
     except FormError as e:
-        return render_template('form.html', **{
+        return _render_template('form.html', **{
             'errors': e.errors,
             'form': request.form,
 
@@ -123,30 +272,36 @@ def add_server():
 @app.route('/moderate', methods=['GET', 'POST'])
 # @auth.login_required
 def moderate():
-    if os.environ.get('USE_DYNAMODB', 'false').lower() != 'true':
+    if not _use_dynamodb():
         abort(404)
     _verify_token()
     request_token = request.args.get('token', '')
     search = request.args.get('search', '')
     if request.method == 'POST':
-        record_id = request.form.get('id')
-        if request.form.get('accept') and record_id:
-            db.update_item(TableName=table,
-                           Key={'id': {'S': record_id}},
-                           UpdateExpression='SET #field = :value',
-                           ExpressionAttributeNames={'#field': 'moderated'},
-                           ExpressionAttributeValues={
-                               ':value': {'BOOL': True},
-                           })
-        elif request.form.get('delete') and record_id:
-            db.delete_item(TableName=table,
-                           Key={'id': {'S': record_id}})
-        elif request.form.get('edit') and record_id:
-            record = _load_data(record_id)
+        # Any number of servers can be selected to accept, delete or edit at
+        # once.
+        record_ids = list(dict.fromkeys(
+            record_id for record_id in request.form.getlist('id')
+            if record_id))
+        # Editing several servers sets the same values on all of them, while
+        # editing just one (without any values) opens the form for it.
+        changes = {field: ' '.join(request.form.get(field, '').split())
+                   for field in Record.bulk_edit_fields}
+        changes = {field: value for field, value in changes.items() if value}
+        if request.form.get('edit') and len(record_ids) == 1 and \
+                not changes:
+            if _wants_json():
+                # Scripts can't open the form, so this is only an error for
+                # them.
+                response = _api_response({
+                    'error': 'No establishment or position to set'})
+                response.status_code = 400
+                return response
+            record = _load_data(record_ids[0])
             if not record:
                 abort(404)
             record = record[0]
-            return render_template('form.html', **{
+            return _render_template('form.html', **{
                 'error': '',
                 'form': record,
                 'record_id': record.id,
@@ -160,18 +315,40 @@ def moderate():
                 'js_comment': Markup('/*'),
                 'js_comment_end': Markup('*/'),
             })
+        updated, deleted, errors = [], [], {}
+        if not record_ids:
+            pass
+        elif request.form.get('accept'):
+            updated, errors = _update_records(record_ids, {'moderated': True})
+        elif request.form.get('delete'):
+            deleted, errors = _delete_records(record_ids)
+        elif request.form.get('edit'):
+            if not changes:
+                abort(400)
+            updated, errors = _update_records(record_ids, changes)
+        if _wants_json():
+            # Scripts get the new state of the queue back straight away,
+            # rather than reloading the page.
+            response = _api_response({
+                'results': [{'id': record_id, 'error': errors.get(record_id)}
+                            for record_id in record_ids],
+                'moderation_results': [
+                    _api_record(record, Record.fields)
+                    for record in _pending_queue(updated, deleted)],
+                'total_active': _active_count(),
+            })
+            response.cache_control.no_store = True
+            return response
         return redirect(url_for('moderate',
                                 token=request_token,
-                                search=search),
+                                search=search,
+                                failed=len(errors) or None),
                         code=303)
-    data = _load_data()
-    total_active = len([True for record in data if record.moderated])
-    search_results = sorted(_do_search(search, data) if search else [],
+    total_active = _active_count()
+    search_results = sorted(_do_search(search, _load_data()) if search else [],
                             key=itemgetter('name'))
-    moderation_results = sorted([record for record in data
-                                 if not record.moderated],
-                                key=itemgetter('name'))
-    return render_template('index.html', **{
+    moderation_results = _pending_queue()
+    response = make_response(_render_template('index.html', **{
         'search': search,
         'is_added': False,
         'is_moderating': True,
@@ -180,6 +357,7 @@ def moderate():
         'random_results': [],
         'request_token': request_token,
         'total_active': total_active,
+        'moderation_failed': request.args.get('failed', 0, type=int),
 
         # These are used to allow opening the template directly as HTML for
         # style editing with placeholder data but also do the right thing when
@@ -188,7 +366,9 @@ def moderate():
         'html_comment_end': Markup('-->'),
         'js_comment': Markup('/*'),
         'js_comment_end': Markup('*/'),
-    })
+    }))
+    response.cache_control.no_store = True
+    return response
 
 
 @app.route('/import')
@@ -197,18 +377,146 @@ def import_from_spreadsheet():
     _verify_token()
     try:
         data = _load_spreadsheet_data()
-
-        # TODO: Use batch_write_item to improve efficiency
-        for record in data:
-            if record._drive_file_id:
-                _save_drive_photo(record)
-                _upload_photo(record)
-                _cleanup_photos(record)
-            db.put_item(TableName=table, Item=record.to_dynamodb())
     except Exception:
         import traceback
         return f'<pre>{traceback.format_exc()}</pre>', 500
-    return 'Imported'
+    results = _import_records(data, full='full' in request.args)
+    failed = [result for result in results if result['error']]
+    lines = [f'Imported {len(results) - len(failed)} of {len(results)} rows',
+             '']
+    for result in results:
+        status = result['error'] or ('unchanged' if result['skipped']
+                                     else 'ok')
+        lines.append(f'{result["id"]:<20} {result["seconds"]:>7.2f}s  '
+                     f'{status}')
+    report = escape('\n'.join(lines))
+    return f'<pre>{report}</pre>', 500 if failed else 200
+
+
+@app.route('/reindex')
+# @auth.login_required
+def reindex():
+    """
+    Rewrite every record with its index keys, and rebuild the pool of
+    moderated IDs and the active count, e.g. after adding an index.
+    """
+    if not _use_dynamodb():
+        abort(404)
+    _verify_token()
+    records = list(_scan_records())
+    unprocessed = _batch_write([{'PutRequest': {'Item': item}}
+                                for item in Record.to_dynamodb_items(records)])
+    _reset_pool()
+    _records_changed()
+    _invalidate_record_cache()
+    active = _active_count()
+    return (f'Reindexed {len(records) - len(unprocessed)} of {len(records)} '
+            f'records, {active} active'), 500 if unprocessed else 200
+
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    fields = _api_fields(Record.listing_fields)
+    data = _load_data(fields=Record.listing_fields)
+    search = ' '.join(request.args.get('search', '').split())
+    results = sorted(_do_search(search, data) if search else [],
+                     key=itemgetter('name', 'id'))
+    return _api_page(results, fields, public=True)
+
+
+@app.route('/api/random', methods=['GET'])
+def api_random():
+    fields = _api_fields(Record.listing_fields)
+    count = _api_int('count', 4)
+    exclude = set(request.args.get('exclude', '').split(','))
+    results = _random_records(count, exclude)
+    response = _api_response({
+        'results': [_api_record(record, fields) for record in results],
+    })
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/records/<record_id>', methods=['GET'])
+def api_record(record_id):
+    is_admin = _has_token()
+    fields = _api_fields(Record.fields if is_admin
+                         else Record.listing_fields)
+    record = _load_data(record_id)
+    if not record or not (is_admin or record[0].moderated):
+        abort(404)
+    response = _api_response({'result': _api_record(record[0], fields)})
+    if is_admin:
+        response.cache_control.no_store = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = page_max_age
+    return response
+
+
+@app.route('/api/venues/<venue>', methods=['GET'])
+def api_venue(venue):
+    fields = _api_fields(Record.listing_fields)
+    results = sorted(_venue_records(venue), key=itemgetter('name', 'id'))
+    return _api_page(results, fields, public=True)
+
+
+@app.route('/api/moderation', methods=['GET'])
+def api_moderation():
+    if not _use_dynamodb():
+        abort(404)
+    _verify_token()
+    fields = _api_fields(Record.fields)
+    results = sorted(_pending_records(), key=itemgetter('name', 'id'))
+    response = _api_page(results, fields)
+    response.cache_control.no_store = True
+    return response
+
+
+@app.route('/profile', methods=['GET'])
+def profile():
+    if not profile_sample_rate:
+        abort(404)
+    _verify_token()
+    with _profile_lock:
+        # In the collapsed format that flame graph tools take.
+        stacks = ''.join(f'{stack} {count}\n'
+                         for stack, count in _profile_stacks.most_common())
+        if 'reset' in request.args:
+            _profile_stacks.clear()
+    response = make_response(stacks)
+    response.mimetype = 'text/plain'
+    response.cache_control.no_store = True
+    return response
+
+
+@app.before_request
+def start_request_timing():
+    if request_timing:
+        g.timings_token = _request_timings.set(RequestTimings())
+    if profile_sample_rate and request.endpoint != 'profile' and \
+            random.random() < profile_sample_rate:
+        g.sampler = StackSampler(threading.get_ident())
+        g.sampler.start()
+
+
+@app.after_request
+def finish_request_timing(response):
+    timings = _request_timings.get()
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.server_timing()
+        _timing_log.info(json.dumps(timings.log_entry(request, response)))
+    return response
+
+
+@app.teardown_request
+def stop_request_timing(exc):
+    sampler = g.pop('sampler', None)
+    if sampler is not None:
+        sampler.stop()
+    token = g.pop('timings_token', None)
+    if token is not None:
+        _request_timings.reset(token)
 
 
 # Helper functions (maybe split into separate file)
@@ -221,7 +529,237 @@ class FormError(Exception):
         self.errors = errors
 
 
-class Record(dict):
+class PhotoRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        # Keep uploaded photos in memory, only spilling over to a temp file
+        # if they are larger than photo_memory_limit.
+        return SpooledTemporaryFile(max_size=photo_memory_limit)
+
+
+app.request_class = PhotoRequest
+
+
+class LazyClient:
+    """
+    Stand-in for a boto3 client which only imports boto3 and creates the
+    client the first time it is used, since both are slow and not every
+    request needs every client.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, service_name):
+        self.service_name = service_name
+        self.client = None
+
+    def __getattr__(self, name):
+        if self.client is None:
+            # Creating clients from the default session isn't thread-safe.
+            with self._lock:
+                if self.client is None:
+                    import boto3
+                    client = boto3.client(self.service_name)
+                    if request_timing:
+                        _instrument_client(client)
+                    self.client = client
+        return getattr(self.client, name)
+
+
+db = LazyClient('dynamodb')
+s3 = LazyClient('s3')
+
+
+# The timings of the current request.  This is a context variable rather than
+# on flask.g, so that work done in thread pools for a request is counted too.
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+_timing_log = logging.getLogger(f'{__name__}.timing')
+_timing_log.setLevel(logging.INFO)
+_timing_log.addHandler(logging.StreamHandler(sys.stdout))
+_timing_log.propagate = False
+
+
+class RequestTimings:
+    """
+    The total time spent in each stage of a request, and the DynamoDB
+    capacity it consumed.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = OrderedDict()
+        self.consumed_capacity = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, consumed_capacity=0.0):
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+            self.consumed_capacity += consumed_capacity
+
+    def server_timing(self):
+        metrics = []
+        for stage, (seconds, count) in self.stages.items():
+            metric = f'{stage};dur={seconds * 1000:.1f}'
+            if count > 1:
+                metric += f';desc="x{count}"'
+            metrics.append(metric)
+        if self.consumed_capacity:
+            metrics.append(
+                f'capacity;desc="{self.consumed_capacity:g} units"')
+        elapsed = time.perf_counter() - self.start
+        metrics.append(f'total;dur={elapsed * 1000:.1f}')
+        return ', '.join(metrics)
+
+    def log_entry(self, request, response):
+        return {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'ms': round((time.perf_counter() - self.start) * 1000, 1),
+            'stages': {stage: {'ms': round(seconds * 1000, 1),
+                               'count': count}
+                       for stage, (seconds, count) in self.stages.items()},
+            'consumed_capacity': self.consumed_capacity,
+        }
+
+
+@contextmanager
+def _timed(stage):
+    """
+    Add the time spent in the block (or decorated function) to the current
+    request's timings, if there is one.
+    """
+    timings = _request_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(stage, time.perf_counter() - start)
+
+
+def _submit(executor, func, *args, **kwargs):
+    # Run the function with the current context, so that its timings count
+    # towards the request that it's working for.
+    return executor.submit(contextvars.copy_context().run, func, *args,
+                           **kwargs)
+
+
+def _render_template(template_name, **context):
+    with _timed('render'):
+        return render_template(template_name, **context)
+
+
+def _instrument_client(client):
+    """
+    Time each call made by a boto3 client, and have DynamoDB report the
+    capacity that each call consumes.
+    """
+    events = client.meta.events
+    events.register('before-parameter-build.dynamodb',
+                    _request_consumed_capacity)
+    events.register('before-call', _start_call_timer)
+    events.register('after-call', _finish_call_timer)
+
+
+def _request_consumed_capacity(params, model, **kwargs):
+    if _request_timings.get() is not None and model.input_shape is not None \
+            and 'ReturnConsumedCapacity' in model.input_shape.members:
+        params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+
+
+def _start_call_timer(context, **kwargs):
+    context['timing_start'] = time.perf_counter()
+
+
+def _finish_call_timer(model, parsed, context, **kwargs):
+    timings = _request_timings.get()
+    if timings is None or 'timing_start' not in context:
+        return
+    consumed = parsed.get('ConsumedCapacity', [])
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    timings.add(f'{model.service_model.endpoint_prefix}.{model.name}',
+                time.perf_counter() - context['timing_start'],
+                sum(entry.get('CapacityUnits', 0) for entry in consumed))
+
+
+# Stacks sampled by the profiler from this container's requests, collapsed to
+# one line per distinct stack.
+_profile_stacks = Counter()
+_profile_lock = threading.Lock()
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of a request's thread until stopped.
+    """
+    def __init__(self, thread_id):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(profile_interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{Path(code.co_filename).stem}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                with _profile_lock:
+                    _profile_stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+@app.cli.command('compile-templates')
+def compile_templates():
+    """Compile the templates into compiled_templates for packaging."""
+    for compiled in compiled_templates_dir.glob('*.py'):
+        compiled.unlink()
+    # Compile from the template sources, even if compiled ones already exist.
+    env = app.jinja_env.overlay(loader=FileSystemLoader(str(_template_dir())))
+    env.compile_templates(str(compiled_templates_dir), zip=None,
+                          ignore_errors=False)
+
+
+def _template_dir():
+    return Path(app.root_path) / app.template_folder
+
+
+def _compiled_templates_current():
+    # Compiled templates left behind by packaging are ignored once a template
+    # has been edited, rather than serving stale pages during development.
+    compiled = [path.stat().st_mtime
+                for path in compiled_templates_dir.glob('*.py')]
+    sources = [path.stat().st_mtime for path in _template_dir().glob('*')]
+    return bool(compiled) and min(compiled) >= max(sources, default=0)
+
+
+if _compiled_templates_current():
+    # Flask's own loader only asks for template sources, which a ModuleLoader
+    # can't provide, so it has to be wrapped around the environment's loader.
+    app.jinja_env.loader = ChoiceLoader([
+        ModuleLoader(str(compiled_templates_dir)),
+        app.jinja_env.loader,
+    ])
+
+
+class Record(Mapping):
+    """
+    A server's record, with a fixed set of fields.
+
+    Fields can be accessed as attributes or by key.  The fields are slots
+    rather than dict entries, so that a table's worth of records takes far
+    less memory and is quicker to build.
+    """
     fields = [
         'id',
         'moderated',
@@ -235,8 +773,32 @@ class Record(dict):
         'paypal',
         'photo',
         'thumbnail',
+        'srcset',
+        'webp_srcset',
+        'avif_srcset',
     ]
+    # The fields needed to render the public listing.
+    listing_fields = (
+        'id',
+        'moderated',
+        'name',
+        'venue',
+        'position',
+        'cash_app',
+        'venmo',
+        'paypal',
+        'photo',
+        'thumbnail',
+        'srcset',
+        'webp_srcset',
+        'avif_srcset',
+    )
+    # The fields that are set by processing the photo.
+    photo_fields = ('photo', 'thumbnail', 'srcset', 'webp_srcset',
+                    'avif_srcset')
     required_fields = ['name', 'email', 'venue', 'position']
+    # The fields that can be set on several records at once when moderating.
+    bulk_edit_fields = ['venue', 'position']
     payment_fields = ['cash_app', 'venmo', 'paypal']
     spreadsheet_columns = {
         'timestamp': 0,
@@ -251,22 +813,51 @@ class Record(dict):
         'thumbnail': 9,
     }
     allowed_image_exts = ['.jpg', '.jpeg', '.png', '.gif']
+    # Attributes which track what an import last wrote for a spreadsheet row.
+    sync_fields = ('sync_hash', 'drive_file_id', 'drive_version')
+    # Attributes derived from the fields for the secondary indexes.
+    index_fields = ('pending', 'name_key', 'venue_key')
+    __slots__ = tuple(fields) + sync_fields
+    defaults = dict({field: '' for field in fields}, moderated=False,
+                    **{field: None for field in sync_fields})
 
     def __init__(self):
-        super().__init__({field: '' for field in self.fields})
-        self['moderated'] = False
-        self._drive_file_id = None
+        for setter, default in self._default_setters:
+            setter(self, default)
 
-    def __getattr__(self, name):
-        if name not in self:
-            raise AttributeError(name)
-        return self[name]
+    def __getitem__(self, name):
+        if name not in self._field_set:
+            raise KeyError(name)
+        return getattr(self, name)
 
-    def __setattr__(self, name, value):
-        if name in self:
-            self[name] = value
-        else:
-            super().__setattr__(name, value)
+    def __setitem__(self, name, value):
+        if name not in self._field_set:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __contains__(self, name):
+        return name in self._field_set
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self._values(self) == self._values(other)
+        if isinstance(other, Mapping):
+            return self.as_dict() == dict(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.as_dict()!r})'
+
+    def as_dict(self):
+        return dict(zip(self.fields, self._values(self)))
 
     @classmethod
     def _validate_request(cls, request):
@@ -317,68 +908,808 @@ class Record(dict):
         self.cash_app = request.form['cash_app']
         self.venmo = request.form['venmo']
         self.paypal = request.form['paypal']
-        photo_filename = _filename(request, 'photo')
-        if photo_filename:
-            suffix = Path(photo_filename).suffix
-            self.photo = f'{photo_bucket_url}{self.id}{suffix}'
-            self.thumbnail = f'{photo_bucket_url}{self.id}-thumb{suffix}'
         return self
 
     @classmethod
     def from_dynamodb(cls, item):
-        self = cls()
-        for field, value in item.items():
-            setattr(self, field, list(value.values())[0])
-        return self
+        return cls.from_dynamodb_items([item])[0]
+
+    @classmethod
+    def from_dynamodb_items(cls, items):
+        """
+        Convert a list of DynamoDB items to records.
+
+        Attributes that aren't record fields, such as the index keys, are
+        skipped.
+        """
+        new = cls.__new__
+        default_setters = cls._default_setters
+        item_setters = cls._item_setters
+        records = []
+        for item in items:
+            self = new(cls)
+            for setter, default in default_setters:
+                setter(self, default)
+            for field, value in item.items():
+                field_setter = item_setters.get(field)
+                if field_setter is not None:
+                    setter, item_type = field_setter
+                    setter(self, value[item_type])
+            records.append(self)
+        return records
 
     @classmethod
     def from_spreadsheet(cls, row_num, data):
         self = cls()
         self.id = f'spreadsheet-{row_num}'
         self.moderated = True
+        self.sync_hash = sha256(json.dumps(data).encode('utf8')).hexdigest()
         for field, col_num in self.spreadsheet_columns.items():
             value = data[col_num] if col_num < len(data) else ''
             setattr(self, field, value)
         if self.photo.startswith('https://drive.google.com/'):
-            self._drive_file_id = parse_qs(urlparse(self.photo).query)['id'][0]
+            self.drive_file_id = parse_qs(urlparse(self.photo).query)['id'][0]
             self.photo = ''
         return self
 
+    def projected(self, fields=None):
+        if fields is None:
+            return self
+        projected = type(self)()
+        for field in fields:
+            setattr(projected, field, getattr(self, field))
+        return projected
+
     def to_dynamodb(self):
-        item = {}
-        for field, value in self.items():
-            if not value:
-                continue
-            item_type = 'BOOL' if field == 'moderated' else 'S'
-            item[field] = {item_type: value}
-        return item
+        return self.to_dynamodb_items([self])[0]
+
+    @classmethod
+    def to_dynamodb_items(cls, records):
+        """
+        Convert a list of records to DynamoDB items.
+        """
+        attributes = cls._item_attributes
+        get_values = cls._item_values
+        items = []
+        for record in records:
+            # Attributes can't be empty strings, so those are left out.
+            item = {field: {item_type: value}
+                    for (field, item_type), value
+                    in zip(attributes, get_values(record)) if value}
+            # Key attributes can't be empty strings, which also keeps records
+            # without a name out of the indexes.
+            name_key = _index_key(record.name)
+            venue_key = _index_key(record.venue)
+            if name_key:
+                item['name_key'] = {'S': name_key}
+                if not record.moderated:
+                    # Only pending records have this, so the index is sparse.
+                    item['pending'] = {'S': '1'}
+            if venue_key:
+                item['venue_key'] = {'S': venue_key}
+            items.append(item)
+        return items
+
+
+# The slot descriptors' setters and the DynamoDB type of each attribute are
+# looked up once here, rather than for every field of every record converted.
+Record._field_set = frozenset(Record.fields)
+Record._values = attrgetter(*Record.fields)
+Record._default_setters = tuple(
+    (getattr(Record, field).__set__, default)
+    for field, default in Record.defaults.items())
+Record._item_attributes = tuple(
+    (field, 'BOOL' if field == 'moderated' else 'S')
+    for field in Record.fields + list(Record.sync_fields))
+Record._item_values = attrgetter(
+    *(field for field, item_type in Record._item_attributes))
+Record._item_setters = {field: (getattr(Record, field).__set__, item_type)
+                        for field, item_type in Record._item_attributes}
+
+
+class RecordJSONEncoder(flask_json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, Record):
+            return o.as_dict()
+        return super().default(o)
+
+
+app.json_encoder = RecordJSONEncoder
+
+
+# Records loaded by a warm container are kept here between invocations, keyed
+# by the fields that were loaded (None for all of them).  Each entry holds the
+# records by ID, along with the data version they were loaded at.
+_record_caches = {}
+_record_cache_lock = threading.RLock()
+# Each change to a cached data set gets a new generation number.
+_data_generations = itertools.count(1)
+
+
+def _use_dynamodb():
+    return os.environ.get('USE_DYNAMODB', 'false').lower() == 'true'
+
+
+@_timed('load')
+def _load_data(item_id=None, fields=None):
+    if item_id is not None:
+        return _load_uncached_data(item_id)
+    with _record_cache_lock:
+        cache = _record_caches.setdefault(fields, {
+            'records': None,
+            'data': None,
+            'search_index': None,
+            'loaded_at': 0,
+            'version': None,
+            'generation': None,
+            'modified': None,
+        })
+        if not _record_cache_fresh(cache):
+            version = _data_version() if _use_dynamodb() else None
+            records = _load_uncached_data(fields=fields)
+            cache['records'] = {record.id: record for record in records}
+            cache['loaded_at'] = time.monotonic()
+            cache['version'] = version
+            cache['modified'] = _now()
+            cache['data'] = None
+        if cache['data'] is None:
+            cache['data'] = list(cache['records'].values())
+            cache['search_index'] = None
+            cache['generation'] = next(_data_generations)
+        return cache['data']
+
+
+def _cache_for(data):
+    """
+    Find the record cache entry that a data set returned by _load_data came
+    from, if it is still current.
+    """
+    with _record_cache_lock:
+        for cache in _record_caches.values():
+            if data is cache['data']:
+                return cache
+    return None
 
-    @property
-    def photo_filename(self):
-        return Path(urlparse(self.photo).path).name
 
-    @property
-    def thumb_filename(self):
-        return Path(urlparse(self.thumbnail).path).name
+def _now():
+    # HTTP dates only have a resolution of seconds.
+    return datetime.now(timezone.utc).replace(microsecond=0)
 
 
-def _load_data(item_id=None):
-    if os.environ.get('USE_DYNAMODB', 'false').lower() == 'true':
-        return _load_dynamodb_data(item_id)
+def _load_uncached_data(item_id=None, fields=None):
+    if _use_dynamodb():
+        return _load_dynamodb_data(item_id, fields)
     else:
         return _load_spreadsheet_data(item_id)
 
 
+def _record_cache_fresh(cache, key='records'):
+    if cache[key] is None:
+        return False
+    if time.monotonic() - cache['loaded_at'] < record_cache_ttl:
+        return True
+    if not record_cache_conditional or not _use_dynamodb():
+        return False
+    # The TTL has expired, but if nothing has been written since we loaded
+    # the records, a single small read of the meta item saves a full scan.
+    version = _data_version()
+    if version is None or version != cache['version']:
+        return False
+    cache['loaded_at'] = time.monotonic()
+    return True
+
+
+def _invalidate_record_cache():
+    with _record_cache_lock:
+        _record_caches.clear()
+        _pool_cache['pool'] = None
+
+
+def _data_version():
+    try:
+        result = db.get_item(TableName=table,
+                             Key={'id': {'S': meta_id}},
+                             ProjectionExpression='data_version',
+                             ConsistentRead=True)
+    except ClientError:
+        return None
+    return int(result.get('Item', {}).get('data_version', {}).get('N', 0))
+
+
+def _bump_data_version(active_delta=0):
+    """
+    Bump the shared data version, returning it and whether the pool items
+    have been built.
+    """
+    # The active count is kept here, rather than on the pool items, so that
+    # it can be read (and changed) without touching the sets of IDs.
+    try:
+        result = db.update_item(TableName=table,
+                                Key={'id': {'S': meta_id}},
+                                UpdateExpression='ADD data_version :one, '
+                                                 'active_count :delta',
+                                ExpressionAttributeValues={
+                                    ':one': {'N': '1'},
+                                    ':delta': {'N': str(active_delta)},
+                                },
+                                ReturnValues='ALL_NEW')
+    except ClientError:
+        return None, False
+    item = result['Attributes']
+    return int(item['data_version']['N']), 'pool_built' in item
+
+
+def _records_changed(updated=(), deleted=(), created=()):
+    """
+    Record a write to the servers table.
+
+    Bumps the shared data version so that other warm containers will reload,
+    and writes the change through to this container's cache so that it can
+    keep serving from memory.  Records that were only just created are
+    passed as created, since they can't be in the pool to be removed.
+    """
+    # Only moderated records are public, so a snapshot is only exported
+    # again when one of them changes.
+    published = any(record.moderated for record in updated) or \
+        any(record.moderated for record in created)
+    unmoderated = [record.id for record in updated
+                   if not record.moderated] + list(deleted)
+    updated = list(updated) + list(created)
+    active_delta = 0
+    removed = None
+    if _use_dynamodb():
+        try:
+            added, removed = _update_pool_items(
+                [record.id for record in updated if record.moderated],
+                unmoderated)
+            active_delta = added - removed
+        except ClientError:
+            # The records have already been written, so the version still
+            # has to be bumped for other containers to see them.  The pool
+            # can be rebuilt with /reindex.
+            app.logger.exception('Failed to update the moderated pool')
+    # The pool is updated first, so that any container that sees the new
+    # version will load the new pool.
+    version, pool_built = _bump_data_version(active_delta)
+    if unmoderated and (removed is None or removed or not pool_built):
+        # A record deleted or taken out of moderation was only public if it
+        # was in the pool, which can't be told until the pool is built.
+        published = True
+    with _record_cache_lock:
+        pool = _pool_cache['pool']
+        if pool is not None:
+            if version is None or _pool_cache['version'] is None or \
+                    version != _pool_cache['version'] + 1:
+                _pool_cache['pool'] = None
+            else:
+                for record in updated:
+                    if record.moderated:
+                        pool.add(record.id)
+                    else:
+                        pool.remove(record.id)
+                for record_id in deleted:
+                    pool.remove(record_id)
+                _pool_cache['version'] = version
+                _pool_cache['modified'] = _now()
+                _pool_cache['generation'] = next(_data_generations)
+        for fields, cache in list(_record_caches.items()):
+            if cache['records'] is None:
+                continue
+            cached_version = cache['version']
+            if version is None or cached_version is None or \
+                    version != cached_version + 1:
+                # Someone else wrote in the meantime, so we can't trust that
+                # applying just our change brings the cache up to date.
+                del _record_caches[fields]
+                continue
+            for record in updated:
+                cache['records'][record.id] = record.projected(fields)
+            for record_id in deleted:
+                cache['records'].pop(record_id, None)
+            cache['version'] = version
+            cache['modified'] = _now()
+            cache['data'] = None
+            cache['search_index'] = None
+    if published and snapshot_export != 'off':
+        _schedule_snapshot()
+
+
+class ModeratedPool:
+    """
+    The IDs of the moderated records, for picking random servers from.
+
+    The IDs are kept in a list so that picking one at random takes constant
+    time, along with a map of their positions so that removing one does too.
+    """
+    def __init__(self, ids=()):
+        self.ids = []
+        self.positions = {}
+        for record_id in ids:
+            self.add(record_id)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, record_id):
+        if record_id not in self.positions:
+            self.positions[record_id] = len(self.ids)
+            self.ids.append(record_id)
+
+    def remove(self, record_id):
+        position = self.positions.pop(record_id, None)
+        if position is None:
+            return
+        last = self.ids.pop()
+        if position < len(self.ids):
+            # Fill the gap with the last ID, rather than shifting them all.
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def sample(self, count, exclude=()):
+        exclude = set(exclude) & self.positions.keys()
+        count = min(count, len(self.ids) - len(exclude))
+        picked = []
+        while len(picked) < count:
+            record_id = self.ids[random.randrange(len(self.ids))]
+            if record_id not in exclude:
+                exclude.add(record_id)
+                picked.append(record_id)
+        return picked
+
+
+# The pool of moderated IDs, cached the same way as the records.
+_pool_cache = {
+    'pool': None,
+    'loaded_at': 0,
+    'version': None,
+    'generation': None,
+    'modified': None,
+}
+
+
+def _moderated_pool():
+    with _record_cache_lock:
+        if not _record_cache_fresh(_pool_cache, 'pool'):
+            version = _data_version() if _use_dynamodb() else None
+            _pool_cache['pool'] = _load_pool()
+            _pool_cache['loaded_at'] = time.monotonic()
+            _pool_cache['version'] = version
+            _pool_cache['modified'] = _now()
+            _pool_cache['generation'] = next(_data_generations)
+        return _pool_cache
+
+
+def _load_pool():
+    if not _use_dynamodb():
+        return ModeratedPool(record.id for record in
+                             _load_data(fields=Record.listing_fields)
+                             if record.moderated)
+    request_items = {table: {
+        'Keys': [{'id': {'S': item_id}}
+                 for item_id in [meta_id] + _pool_item_ids()],
+        'ConsistentRead': True,
+    }}
+    items = {}
+    for attempt in range(8):
+        if attempt:
+            time.sleep(random.uniform(0, min(0.05 * 2 ** attempt, 5)))
+        result = db.batch_get_item(RequestItems=request_items)
+        items.update((item['id']['S'], item)
+                     for item in result['Responses'].get(table, []))
+        request_items = result.get('UnprocessedKeys')
+        if not request_items:
+            break
+    meta = items.pop(meta_id, {})
+    if 'pool_built' in meta:
+        return ModeratedPool(itertools.chain.from_iterable(
+            item.get('ids', {}).get('SS', []) for item in items.values()))
+    # First time, so the pool has to be built from the records.  Each item
+    # that isn't built yet is built on its own, and only if nothing has
+    # written to it since it was read above: records are written before the
+    # pool, so a change that the scan might have missed always shows up as
+    # a changed write count.
+    shards = {item_id: [] for item_id in _pool_item_ids()}
+    for record in _load_data(fields=Record.listing_fields):
+        if record.moderated:
+            shards[_pool_item_id(record.id)].append(record.id)
+    ids = []
+    built = True
+    for item_id, item_ids in shards.items():
+        item = items.get(item_id, {})
+        if 'built' in item:
+            ids.extend(item.get('ids', {}).get('SS', []))
+            continue
+        ids.extend(item_ids)
+        if not _build_pool_item(item_id, item_ids, item.get('write_count')):
+            # Left to be built again next time.
+            built = False
+    if built:
+        db.update_item(TableName=table,
+                       Key={'id': {'S': meta_id}},
+                       UpdateExpression='SET pool_built = :built',
+                       ExpressionAttributeValues={':built': {'BOOL': True}})
+    return ModeratedPool(ids)
+
+
+def _build_pool_item(item_id, ids, write_count):
+    """
+    Put a pool item built from the records, unless it has been built or
+    written to since it was read, adding its IDs to the active count in the
+    same transaction.  Returns whether it was built.
+    """
+    item = {'id': {'S': item_id}, 'built': {'BOOL': True}}
+    if ids:
+        item['ids'] = {'SS': ids}
+    put = {'TableName': table, 'Item': item}
+    if write_count is None:
+        put['ConditionExpression'] = ('attribute_not_exists(built) AND '
+                                      'attribute_not_exists(write_count)')
+    else:
+        item['write_count'] = write_count
+        put['ConditionExpression'] = ('attribute_not_exists(built) AND '
+                                      'write_count = :write_count')
+        put['ExpressionAttributeValues'] = {':write_count': write_count}
+    try:
+        db.transact_write_items(TransactItems=[
+            {'Put': put},
+            {'Update': {
+                'TableName': table,
+                'Key': {'id': {'S': meta_id}},
+                'UpdateExpression': 'ADD active_count :count',
+                'ExpressionAttributeValues': {
+                    ':count': {'N': str(len(ids))}},
+            }},
+        ])
+    except ClientError:
+        return False
+    return True
+
+
+def _reset_pool():
+    """
+    Delete the pool items, so that the pool is built again from the records
+    when it is next needed.
+    """
+    db.update_item(TableName=table,
+                   Key={'id': {'S': meta_id}},
+                   UpdateExpression='REMOVE pool_built, active_count')
+    _batch_write([{'DeleteRequest': {'Key': {'id': {'S': item_id}}}}
+                  for item_id in _pool_item_ids()])
+
+
+def _pool_item_ids():
+    return [f'{pool_prefix}{shard}__' for shard in range(pool_shards)]
+
+
+def _pool_item_id(record_id):
+    # Hashed, so that IDs spread evenly over the items whatever their form.
+    shard = int(sha256(record_id.encode('utf8')).hexdigest()[:8], 16)
+    return f'{pool_prefix}{shard % pool_shards}__'
+
+
+def _update_pool_items(added, removed, max_attempts=8):
+    """
+    Add and remove IDs from the pool items, with one update per item
+    changed, returning how many IDs were added and how many removed.
+
+    Each update returns the item as it was before, so that IDs which were
+    already in it (or already gone) aren't counted, and neither are any
+    changes to an item that hasn't been built yet, whose IDs are counted
+    when it is.  Each update also bumps the item's write count, which stops
+    a build that started before it from overwriting it.
+    """
+    changes = defaultdict(lambda: ([], []))
+    for record_id in set(added):
+        changes[_pool_item_id(record_id)][0].append(record_id)
+    for record_id in set(removed):
+        changes[_pool_item_id(record_id)][1].append(record_id)
+    added_count = removed_count = 0
+    for item_id, (item_added, item_removed) in changes.items():
+        # DynamoDB won't change the same attribute twice in one update, so
+        # an item with IDs both added and removed takes two.
+        for action, ids in (('ADD', item_added), ('DELETE', item_removed)):
+            if not ids:
+                continue
+            for attempt in range(max_attempts):
+                if attempt:
+                    time.sleep(random.uniform(0, min(0.05 * 2 ** attempt, 5)))
+                try:
+                    result = db.update_item(
+                        TableName=table,
+                        Key={'id': {'S': item_id}},
+                        UpdateExpression=(
+                            'ADD ids :ids, write_count :one'
+                            if action == 'ADD' else
+                            'DELETE ids :ids ADD write_count :one'),
+                        ExpressionAttributeValues={
+                            ':ids': {'SS': ids},
+                            ':one': {'N': '1'},
+                        },
+                        ReturnValues='ALL_OLD')
+                    break
+                except ClientError as e:
+                    code = e.response.get('Error', {}).get('Code')
+                    if code != 'ProvisionedThroughputExceededException' or \
+                            attempt == max_attempts - 1:
+                        raise
+            before = result.get('Attributes', {})
+            if 'built' not in before:
+                continue
+            before = set(before.get('ids', {}).get('SS', []))
+            if action == 'ADD':
+                added_count += len(set(ids) - before)
+            else:
+                removed_count += len(set(ids) & before)
+    return added_count, removed_count
+
+
+def _active_count():
+    if _use_dynamodb():
+        result = db.get_item(TableName=table,
+                             Key={'id': {'S': meta_id}},
+                             ProjectionExpression='active_count, pool_built',
+                             ConsistentRead=True)
+        item = result.get('Item', {})
+        if 'pool_built' in item:
+            return int(item.get('active_count', {}).get('N', 0))
+    # Loading the pool builds the pool items, and the count, if need be.
+    return len(_moderated_pool()['pool'])
+
+
+def _pending_records():
+    if not _use_dynamodb():
+        return []
+    return list(_query_records(pending_index, 'pending', '1'))
+
+
+def _pending_queue(updated=(), deleted=()):
+    """
+    The records awaiting moderation, sorted by name.
+
+    The pending index is only eventually consistent, so records that have
+    just been updated or deleted are applied on top of it.
+    """
+    queue = {record.id: record for record in _pending_records()}
+    for record in updated:
+        if record.moderated:
+            queue.pop(record.id, None)
+        else:
+            queue[record.id] = record
+    for record_id in deleted:
+        queue.pop(record_id, None)
+    return sorted(queue.values(), key=itemgetter('name'))
+
+
+def _venue_records(venue):
+    venue_key = _index_key(venue)
+    if not venue_key:
+        return []
+    if not _use_dynamodb():
+        return [record for record in _load_data(fields=Record.listing_fields)
+                if record.moderated and _index_key(record.venue) == venue_key]
+    return [record for record in _query_records(venue_index, 'venue_key',
+                                                venue_key,
+                                                Record.listing_fields)
+            if record.moderated]
+
+
+def _query_records(index_name, key_field, value, fields=None):
+    """
+    Generate the Records with the given key value in a secondary index.
+    """
+    projection = _projection_args(fields)
+    query_args = {
+        'TableName': table,
+        'IndexName': index_name,
+        'KeyConditionExpression': '#key = :value',
+        **projection,
+        'ExpressionAttributeNames': {
+            **projection.get('ExpressionAttributeNames', {}),
+            '#key': key_field,
+        },
+        'ExpressionAttributeValues': {':value': {'S': value}},
+    }
+    while True:
+        result = db.query(**query_args)
+        yield from Record.from_dynamodb_items(result.get('Items', []))
+        if 'LastEvaluatedKey' not in result:
+            break
+        query_args['ExclusiveStartKey'] = result['LastEvaluatedKey']
+
+
+def _index_key(value):
+    return ' '.join(value.lower().split())
+
+
+def _random_records(count, exclude=()):
+    pool = _moderated_pool()['pool']
+    return _load_records(pool.sample(count, exclude))
+
+
+def _load_records(ids, fields=Record.listing_fields):
+    """
+    Load the records with the given IDs, from the cache if it is warm.
+    """
+    if not ids:
+        return []
+    with _record_cache_lock:
+        cache = _record_caches.get(fields)
+        warm = cache is not None and _record_cache_fresh(cache)
+        if warm or not _use_dynamodb():
+            _load_data(fields=fields)
+            records = _record_caches[fields]['records']
+            return [records[record_id] for record_id in ids
+                    if record_id in records]
+    return _batch_get(ids, fields)
+
+
+def _batch_get(ids, fields=None, consistent=False, max_attempts=8):
+    """
+    Get the records with the given IDs using batch_get_item, in the order of
+    the IDs.
+
+    Keys that DynamoDB leaves unprocessed are retried with exponential
+    backoff.  IDs without a record are left out.
+    """
+    records = []
+    for start in range(0, len(ids), batch_get_size):
+        request_items = {table: {
+            'Keys': [{'id': {'S': record_id}}
+                     for record_id in ids[start:start + batch_get_size]],
+            **_projection_args(fields),
+        }}
+        if consistent:
+            request_items[table]['ConsistentRead'] = True
+        for attempt in range(max_attempts):
+            if attempt:
+                time.sleep(random.uniform(0, min(0.05 * 2 ** attempt, 5)))
+            result = db.batch_get_item(RequestItems=request_items)
+            records.extend(Record.from_dynamodb_items(
+                result['Responses'].get(table, [])))
+            request_items = result.get('UnprocessedKeys')
+            if not request_items:
+                break
+    order = {record_id: i for i, record_id in enumerate(ids)}
+    return sorted(records, key=lambda record: order[record.id])
+
+
+@_timed('search')
 def _do_search(search, data):
-    active = [record for record in data if record.moderated]
-    search_results = process.extractBests(search, active,
-                                          limit=None,
-                                          score_cutoff=60)
-    return [result[0] for result in search_results]
+    return _search_index(data).search(search)
+
+
+def _search_index(data):
+    with _record_cache_lock:
+        cache = _cache_for(data)
+        if cache is None:
+            # Not a cached data set, so there's nothing to reuse the index
+            # with afterwards.
+            return SearchIndex(data)
+        if cache['search_index'] is None:
+            cache['search_index'] = SearchIndex(data)
+        return cache['search_index']
+
+
+# Rendered public pages, most recently used last.
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+
+
+def _cached_page(key, cache, render):
+    """
+    Respond with a rendered page, reusing a previous render of it if the
+    cache entry it was rendered from hasn't changed.
 
+    The response can be cached publicly, and conditional requests for a page
+    that hasn't changed get a 304 response.
+    """
+    generation = cache['generation'] if cache else None
+    modified = cache['modified'] if cache else _now()
+    with _page_cache_lock:
+        page = _page_cache.get(key)
+        if page is not None:
+            _page_cache.move_to_end(key)
+    if page is None or generation is None or \
+            page['generation'] != generation or \
+            time.monotonic() - page['rendered_at'] >= page_cache_ttl:
+        body = render().encode('utf8')
+        page = {
+            'body': body,
+            'etag': sha256(body).hexdigest(),
+            'generation': generation,
+            'modified': modified,
+            'rendered_at': time.monotonic(),
+        }
+        if generation is not None:
+            with _page_cache_lock:
+                _page_cache[key] = page
+                while len(_page_cache) > page_cache_size:
+                    _page_cache.popitem(last=False)
+    response = make_response(page['body'])
+    response.set_etag(page['etag'])
+    response.last_modified = page['modified']
+    response.cache_control.public = True
+    response.cache_control.max_age = page_max_age
+    response.headers['Cache-Control'] += \
+        f', stale-while-revalidate={page_stale_while_revalidate}'
+    return response.make_conditional(request)
+
+
+class SearchIndex:
+    """
+    Fuzzy search over the searchable fields of the moderated records.
+
+    Trigrams of each record's search text are indexed when the index is
+    built, so a query only has to be scored against the records that share
+    some of its trigrams rather than against every record.
+    """
+    search_fields = ['name', 'venue', 'position']
+    score_cutoff = 60
+    # Fraction of the query's trigrams that a record must share to be scored.
+    candidate_overlap = 0.25
+
+    def __init__(self, data):
+        self.records = [record for record in data if record.moderated]
+        self.choices = [self._search_text(record) for record in self.records]
+        self.trigrams = defaultdict(list)
+        for i, choice in enumerate(self.choices):
+            for trigram in self._trigrams(choice):
+                self.trigrams[trigram].append(i)
 
-def _load_dynamodb_data(item_id=None):
+    @classmethod
+    def _search_text(cls, record):
+        from fuzzywuzzy.utils import full_process
+        return full_process(
+            ' '.join(record[field] for field in cls.search_fields))
+
+    @staticmethod
+    def _trigrams(text):
+        trigrams = set()
+        for word in text.split():
+            padded = f' {word} '
+            trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        return trigrams
+
+    def candidates(self, query):
+        trigrams = self._trigrams(query)
+        counts = Counter()
+        for trigram in trigrams:
+            counts.update(self.trigrams.get(trigram, ()))
+        min_overlap = max(1, int(len(trigrams) * self.candidate_overlap))
+        return [i for i, count in counts.items() if count >= min_overlap]
+
+    def search(self, search):
+        from fuzzywuzzy.fuzz import WRatio
+        from fuzzywuzzy.utils import full_process
+        query = full_process(search)
+        if not query:
+            return []
+        scored = []
+        for i in self.candidates(query):
+            score = WRatio(query, self.choices[i], full_process=False)
+            if score >= self.score_cutoff:
+                scored.append((score, i))
+        scored.sort(key=lambda result: (-result[0], result[1]))
+        return [self.records[i] for score, i in scored]
+
+    def as_dict(self):
+        """
+        The index's search texts and trigrams, in the order of its records,
+        along with the settings needed to search it the same way.
+        """
+        return {
+            'fields': self.search_fields,
+            'score_cutoff': self.score_cutoff,
+            'candidate_overlap': self.candidate_overlap,
+            'choices': self.choices,
+            'trigrams': self.trigrams,
+        }
+
+
+def _load_dynamodb_data(item_id=None, fields=None):
     if item_id is not None:
+        if item_id.startswith(meta_prefix):
+            return []
         result = db.get_item(TableName=table, Key={'id': {'S': item_id}})
         if 'Item' not in result:
             return []
@@ -386,17 +1717,353 @@ def _load_dynamodb_data(item_id=None):
     # XXX Full table scan; totally won't scale, but we're doing this for now
     # for the fuzzy searching and random results, and we don't have enough
     # data yet to worry about integrating ElasticSearch.
-    results = db.scan(TableName=table)
-    if 'Items' not in results:
-        return []
-    return [Record.from_dynamodb(item) for item in results['Items']]
+    return list(_scan_records(fields))
+
+
+def _projection_args(fields):
+    if fields is None:
+        return {}
+    # Attribute names are used for every field, since some (like name) are
+    # reserved words.
+    names = {f'#f{i}': field for i, field in enumerate(fields)}
+    return {
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names,
+    }
+
+
+def _scan_records(fields=None, segments=None):
+    """
+    Generate Records for every item in the servers table.
+
+    The scan is split into segments which are read in parallel, each
+    following LastEvaluatedKey until its part of the table is exhausted.
+    Records are yielded as each page arrives.  If fields is given, only
+    those attributes are fetched.
+    """
+    segments = segments or scan_segments
+    scan_args = {'TableName': table, **_projection_args(fields)}
+    pages = queue.Queue()
+    finished = object()
+
+    def scan_segment(segment):
+        try:
+            segment_args = dict(scan_args)
+            if segments > 1:
+                segment_args.update(Segment=segment, TotalSegments=segments)
+            while True:
+                result = db.scan(**segment_args)
+                pages.put(result.get('Items', []))
+                if 'LastEvaluatedKey' not in result:
+                    break
+                segment_args['ExclusiveStartKey'] = result['LastEvaluatedKey']
+        finally:
+            pages.put(finished)
+
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [_submit(executor, scan_segment, segment)
+                   for segment in range(segments)]
+        remaining = segments
+        while remaining:
+            page = pages.get()
+            if page is finished:
+                remaining -= 1
+                continue
+            yield from Record.from_dynamodb_items(
+                [item for item in page
+                 if not item['id']['S'].startswith(meta_prefix)])
+        for future in futures:
+            # Re-raise any errors from the segment scans.
+            future.result()
+
+
+def _import_records(data, full=False):
+    """
+    Write records from the spreadsheet to the servers table.
+
+    Unless a full import is requested, only rows whose contents or Drive
+    photo have changed since they were last imported are written.  The
+    content hash and Drive file version are stored on each record as it is
+    written, so an import which is interrupted picks up where it stopped.
+
+    Drive photos are processed on a pool of workers, and the records are
+    written in batches as they become ready.  Returns a result for each row,
+    with how long it took and the error that stopped it, if any.
+    """
+    results = {record.id: {'id': record.id,
+                           'seconds': 0.0,
+                           'error': None,
+                           'skipped': False}
+               for record in data}
+    if full:
+        previous = {}
+    else:
+        previous = {record.id: record for record in _scan_records(
+            ('id',) + Record.photo_fields + Record.sync_fields)}
+    written = []
+    pending = []
+
+    def flush():
+        unprocessed = _batch_write(
+            [{'PutRequest': {'Item': item}}
+             for item in Record.to_dynamodb_items(pending)])
+        failed_ids = {request['PutRequest']['Item']['id']['S']
+                      for request in unprocessed}
+        for record in pending:
+            if record.id in failed_ids:
+                results[record.id]['error'] = 'Failed to save record'
+            else:
+                written.append(record)
+        pending.clear()
+
+    def import_photo(record, prior):
+        start = time.perf_counter()
+        try:
+            metadata = _drive_metadata(record.drive_file_id)
+            record.drive_version = metadata.get('version')
+            if prior is not None and prior.photo and \
+                    prior.drive_file_id == record.drive_file_id and \
+                    prior.drive_version == record.drive_version:
+                # Same photo as last time, so it's already in S3.
+                for field in Record.photo_fields:
+                    record[field] = prior[field]
+                return prior.sync_hash != record.sync_hash
+            with _fetch_drive_photo(record) as photo:
+                _upload_photo(record, photo, _drive_suffix(metadata))
+            return True
+        finally:
+            results[record.id]['seconds'] = time.perf_counter() - start
+
+    futures = {}
+    for record in data:
+        prior = previous.get(record.id)
+        if record.drive_file_id:
+            futures[_submit(_import_executor, import_photo, record,
+                            prior)] = record
+        elif prior is None or prior.sync_hash != record.sync_hash:
+            pending.append(record)
+        else:
+            results[record.id]['skipped'] = True
+    for future in as_completed(futures):
+        record = futures[future]
+        try:
+            changed = future.result()
+        except FormError as e:
+            results[record.id]['error'] = f'{e.errors[0]}: {e.__cause__}'
+            continue
+        except Exception as e:
+            results[record.id]['error'] = repr(e)
+            continue
+        if not changed:
+            results[record.id]['skipped'] = True
+            continue
+        pending.append(record)
+        if len(pending) >= batch_write_size:
+            flush()
+    if pending:
+        flush()
+    if written:
+        _records_changed(updated=written)
+    return [results[record.id] for record in data]
+
+
+def _batch_write(requests, max_attempts=8):
+    """
+    Send write requests to the servers table using batch_write_item.
+
+    Items that DynamoDB leaves unprocessed, or that were throttled, are
+    retried with exponential backoff.  Returns the requests that still
+    could not be written.
+    """
+    failed = []
+    for start in range(0, len(requests), batch_write_size):
+        chunk = requests[start:start + batch_write_size]
+        attempt = 0
+        while chunk:
+            try:
+                result = db.batch_write_item(RequestItems={table: chunk})
+                chunk = result.get('UnprocessedItems', {}).get(table, [])
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code != 'ProvisionedThroughputExceededException':
+                    break
+            attempt += 1
+            if not chunk or attempt >= max_attempts:
+                break
+            # Full jitter, so concurrent writers don't retry in lockstep.
+            time.sleep(random.uniform(0, min(0.05 * 2 ** attempt, 5)))
+        failed.extend(chunk)
+    return failed
+
+
+# Reasons a transaction, or an item in one, can fail that are worth retrying.
+_transact_retry_codes = {
+    'None',
+    'TransactionConflict',
+    'TransactionConflictException',
+    'TransactionInProgressException',
+    'ProvisionedThroughputExceeded',
+    'ProvisionedThroughputExceededException',
+    'ThrottlingError',
+    'ThrottlingException',
+}
+
+
+def _transact_write(items, max_attempts=8):
+    """
+    Send write requests to the servers table using transact_write_items.
+
+    A transaction is cancelled as a whole if any of its items fails, so the
+    items that can't succeed (such as failed conditions) are dropped and the
+    rest retried, with exponential backoff.  Returns (item, error code)
+    pairs for the items that could not be written.
+    """
+    failed = []
+    for start in range(0, len(items), transact_write_size):
+        chunk = items[start:start + transact_write_size]
+        attempt = 0
+        while chunk:
+            try:
+                db.transact_write_items(TransactItems=chunk)
+                break
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                # Each item's reason is only given when a transaction is
+                # cancelled; other errors apply to all of them.
+                reasons = e.response.get('CancellationReasons') or \
+                    [{'Code': code}] * len(chunk)
+                retry = []
+                for item, reason in zip(chunk, reasons):
+                    if reason.get('Code') in _transact_retry_codes:
+                        retry.append(item)
+                    else:
+                        failed.append((item, reason.get('Code')))
+                chunk = retry
+            attempt += 1
+            if chunk and attempt >= max_attempts:
+                failed.extend((item, 'TooManyAttempts') for item in chunk)
+                break
+            if chunk:
+                time.sleep(random.uniform(0, min(0.05 * 2 ** attempt, 5)))
+    return failed
+
+
+def _update_records(record_ids, changes):
+    """
+    Set fields to the same values on several records, keeping their index
+    keys in step.
+
+    Returns the updated records, and an error message for each ID that
+    couldn't be updated.
+    """
+    names = {f'#f{i}': field for i, field in enumerate(changes)}
+    values = {
+        f':f{i}': {'BOOL' if field == 'moderated' else 'S': value}
+        for i, (field, value) in enumerate(changes.items())
+    }
+    expression = 'SET ' + ', '.join(f'#f{i} = :f{i}'
+                                    for i in range(len(changes)))
+    if 'venue' in changes:
+        expression += ', venue_key = :venue_key'
+        values[':venue_key'] = {'S': _index_key(changes['venue'])}
+    if changes.get('moderated'):
+        # Removing pending takes the record out of the pending index.
+        expression += ' REMOVE pending'
+    failed = _transact_write([{'Update': {
+        'TableName': table,
+        'Key': {'id': {'S': record_id}},
+        'UpdateExpression': expression,
+        # Rather than creating an empty record for one that was deleted.
+        'ConditionExpression': 'attribute_exists(id)',
+        'ExpressionAttributeNames': names,
+        'ExpressionAttributeValues': values,
+    }} for record_id in record_ids])
+    errors = {
+        item['Update']['Key']['id']['S']:
+            'Not found' if code == 'ConditionalCheckFailed'
+            else f'Failed to save record ({code})'
+        for item, code in failed
+    }
+    updated = _batch_get([record_id for record_id in record_ids
+                          if record_id not in errors], consistent=True)
+    if updated:
+        _records_changed(updated=updated)
+    return updated, errors
+
+
+def _delete_records(record_ids):
+    """
+    Delete several records.
+
+    Returns the IDs deleted, and an error message for each ID that couldn't
+    be.
+    """
+    failed = _transact_write([{'Delete': {
+        'TableName': table,
+        'Key': {'id': {'S': record_id}},
+        # So that IDs without a record are reported, as they are by
+        # _update_records, rather than passed on as deleted.
+        'ConditionExpression': 'attribute_exists(id)',
+    }} for record_id in record_ids])
+    errors = {
+        item['Delete']['Key']['id']['S']:
+            'Not found' if code == 'ConditionalCheckFailed'
+            else f'Failed to delete record ({code})'
+        for item, code in failed
+    }
+    deleted = [record_id for record_id in record_ids
+               if record_id not in errors]
+    if deleted:
+        _records_changed(deleted=deleted)
+    return deleted, errors
+
+
+# Google API credentials are shared by every thread and refreshed in place,
+# but the services built on them are not thread-safe, so each thread keeps
+# its own.  Both survive between invocations in a warm container.
+_gapi_credentials = None
+_gapi_lock = threading.Lock()
+_gapi_services = threading.local()
+# The import's worker threads are kept too, so that the services they build
+# are reused by later imports rather than being built again in new threads.
+_import_executor = ThreadPoolExecutor(max_workers=import_workers)
 
 
 def _gapi(api_name, version):
-    creds = pickle.loads(b64decode(os.environ['GOOGLE_TOKEN']))
-    service = build(api_name, version, credentials=creds,
-                    cache_discovery=False)
-    return service
+    creds = _gapi_creds()
+    services = _gapi_services.__dict__.setdefault('services', {})
+    if (api_name, version) not in services:
+        # The Google API client is only needed for imports, and is slow to
+        # import, so it isn't loaded until then.
+        from googleapiclient.discovery import build, build_from_document
+        document = discovery_dir / f'{api_name}.{version}.json'
+        if document.exists():
+            service = build_from_document(document.read_text(),
+                                          credentials=creds)
+        else:
+            service = build(api_name, version, credentials=creds,
+                            cache_discovery=False)
+        services[(api_name, version)] = service
+    return services[(api_name, version)]
+
+
+def _gapi_creds():
+    global _gapi_credentials
+    with _gapi_lock:
+        if _gapi_credentials is None:
+            _gapi_credentials = pickle.loads(
+                b64decode(os.environ['GOOGLE_TOKEN']))
+        creds = _gapi_credentials
+        expiry = getattr(creds, 'expiry', None)
+        expiring = expiry is not None and \
+            expiry - datetime.utcnow() < gapi_refresh_margin
+        if getattr(creds, 'refresh_token', None) and \
+                (not creds.token or expiring):
+            # Refresh before the token expires, rather than having a request
+            # fail part way through an import.
+            from google.auth.transport.requests import Request
+            creds.refresh(Request())
+        return creds
 
 
 def _load_spreadsheet_data(item_id=None):
@@ -405,10 +2072,17 @@ def _load_spreadsheet_data(item_id=None):
     RANGE_NAME = "'Live on Site'!A2:J"
 
     sheet = _gapi('sheets', 'v4').spreadsheets()
-    results = sheet.values().get(spreadsheetId=SPREADSHEET_ID,
-                                 range=RANGE_NAME).execute().get('values', [])
-    return [Record.from_spreadsheet(row_num, data)
-            for row_num, data in enumerate(results)]
+    with _timed('sheets'):
+        results = sheet.values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range=RANGE_NAME).execute().get('values', [])
+    records = [Record.from_spreadsheet(row_num, data)
+               for row_num, data in enumerate(results)]
+    if item_id is not None:
+        # The sheet can only be read whole, so a single record is picked out
+        # of it afterwards.
+        records = [record for record in records if record.id == item_id]
+    return records
 
 
 def _filename(request, field):
@@ -417,62 +2091,570 @@ def _filename(request, field):
     return request.files[field].filename or None
 
 
-def _save_form_photo(record):
-    request.files['photo'].save(f'/tmp/{record.photo_filename}')
+def _drive_metadata(file_id):
+    drive = _gapi('drive', 'v3').files()
+    with _timed('drive'):
+        return drive.get(fileId=file_id, fields='mimeType,version').execute()
 
 
-def _save_drive_photo(record):
-    drive = _gapi('drive', 'v3').files()
+def _drive_suffix(metadata):
+    return '.' + metadata['mimeType'].split('/')[1]
 
-    metadata = drive.get(fileId=record._drive_file_id).execute()
-    suffix = '.' + metadata['mimeType'].split('/')[1]
-    record.photo = f'{photo_bucket_url}{record.id}{suffix}'
-    record.thumbnail = f'{photo_bucket_url}{record.id}-thumb{suffix}'
 
-    request = drive.get_media(fileId=record._drive_file_id)
-    with open(f'/tmp/{record.photo_filename}', 'wb') as fh:
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
+def _fetch_drive_photo(record):
+    drive = _gapi('drive', 'v3').files()
+    from googleapiclient.http import MediaIoBaseDownload
+    request = drive.get_media(fileId=record.drive_file_id)
+    photo = SpooledTemporaryFile(max_size=photo_memory_limit)
+    downloader = MediaIoBaseDownload(photo, request)
+    done = False
+    with _timed('drive'):
         while done is False:
             status, done = downloader.next_chunk()
+    photo.seek(0)
+    return photo
+
+
+# Background threads for processing queued photos, when photo_processing is
+# 'thread'.  Threads are only started once there are photos to process.
+_photo_executor = ThreadPoolExecutor(max_workers=photo_workers)
+
+
+@app.cli.command('process-photos')
+@click.option('--once', is_flag=True,
+              help='Exit once the queue is empty, rather than waiting.')
+def process_photos(once):
+    """Process the photos queued by form submissions."""
+    while True:
+        jobs = sorted(photo_queue_dir.glob('*.json'))
+        for job_path in jobs:
+            _run_photo_job(job_path)
+        if once:
+            break
+        if not jobs:
+            time.sleep(1)
+
+
+def _queue_photo(record, photo, suffix):
+    """
+    Save a photo to the queue directory to be processed later, and clear the
+    record's thumbnail until it is.
+
+    If the same photo has already been uploaded, the record is pointed at it
+    instead and nothing is queued.
+    """
+    suffix = suffix.lower()
+    if _find_photo(record, _photo_digest(photo), suffix):
+        return None
+    photo_queue_dir.mkdir(parents=True, exist_ok=True)
+    job_id = f'{time.time_ns()}-{uuid4()}'
+    job = {
+        'id': job_id,
+        'file': f'{job_id}{suffix}',
+        'record_id': record.id,
+        'suffix': suffix,
+    }
+    with (photo_queue_dir / job['file']).open('wb') as queued:
+        shutil.copyfileobj(photo, queued)
+    for field in Record.photo_fields:
+        if field != 'photo':
+            record[field] = ''
+    return job
+
+
+def _submit_photo_job(job):
+    # The job file is renamed into place, so that a worker never sees it
+    # half written.
+    job_path = photo_queue_dir / f'{job["id"]}.json'
+    partial_path = job_path.with_suffix('.partial')
+    partial_path.write_text(json.dumps(job))
+    partial_path.rename(job_path)
+    if photo_processing == 'thread':
+        _photo_executor.submit(_run_photo_job, job_path)
+
+
+def _run_photo_job(job_path):
+    """
+    Make and upload the derivatives of a queued photo, and save them on its
+    record.
+    """
+    working_path = job_path.with_suffix('.working')
+    try:
+        # Claim the job, in case another worker has also found it.
+        job_path.rename(working_path)
+    except FileNotFoundError:
+        return
+    job = json.loads(working_path.read_text())
+    photo_path = photo_queue_dir / job['file']
+    record = Record()
+    record.id = job['record_id']
+    try:
+        with photo_path.open('rb') as photo:
+            _upload_photo(record, photo, job['suffix'])
+        fields = [field for field in Record.photo_fields if record[field]]
+        try:
+            result = db.update_item(
+                TableName=table,
+                Key={'id': {'S': record.id}},
+                UpdateExpression='SET ' + ', '.join(
+                    f'#f{i} = :f{i}' for i in range(len(fields))),
+                # The record may have been deleted while its photo waited.
+                ConditionExpression='attribute_exists(id)',
+                ExpressionAttributeNames={
+                    f'#f{i}': field for i, field in enumerate(fields)},
+                ExpressionAttributeValues={
+                    f':f{i}': {'S': record[field]}
+                    for i, field in enumerate(fields)},
+                ReturnValues='ALL_NEW')
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code != 'ConditionalCheckFailedException':
+                raise
+        else:
+            _records_changed(
+                updated=[Record.from_dynamodb(result['Attributes'])])
+    except Exception:
+        app.logger.exception('Failed to process photo %s', job['file'])
+        working_path.rename(job_path.with_suffix('.failed'))
+        return
+    working_path.unlink()
+    photo_path.unlink()
+
+
+def _photo_digest(photo):
+    """
+    Hash the contents of a photo file, for the keys it is stored under.
+    """
+    digest = sha256()
+    for chunk in iter(functools.partial(photo.read, 1024 * 1024), b''):
+        digest.update(chunk)
+    photo.seek(0)
+    return digest.hexdigest()[:32]
+
+
+def _find_photo(record, digest, suffix):
+    """
+    Point the record at the photo with the given digest, returning whether it
+    has already been uploaded.
+
+    If it has, its srcsets are set from the widths and formats listed in the
+    original's metadata, so the record can share its derivatives too.
+    """
+    key = f'{digest}{suffix}'
+    record.photo = f'{photo_bucket_url}{key}'
+    record.thumbnail = f'{photo_bucket_url}{digest}-thumb{suffix}'
+    try:
+        metadata = s3.head_object(Bucket=photo_bucket_name,
+                                  Key=key)['Metadata']
+    except ClientError as e:
+        code = e.response.get('Error', {}).get('Code')
+        if code in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        if app.debug:
+            raise
+        raise FormError('Unable to upload photo') from e
+    _set_srcsets(record, digest, metadata)
+    return True
 
 
-def _upload_photo(record):
-    content_type = mimetypes.guess_type(record.photo_filename)[0]
-    photo_tmp_file = f'/tmp/{record.photo_filename}'
-    thumb_tmp_file = f'/tmp/{record.thumb_filename}'
+def _set_srcsets(record, digest, metadata):
+    widths = [width.split(':') for width in metadata['widths'].split()]
+    formats = [fmt.split(':') for fmt in metadata['formats'].split()]
+    srcsets = {
+        fmt: ', '.join(f'{photo_bucket_url}{digest}-{width}w{suffix} {actual}w'
+                       for width, actual in reversed(widths))
+        for fmt, suffix in formats
+    }
+    record.srcset = srcsets[formats[0][0]]
+    record.webp_srcset = srcsets.get('WEBP', '')
+    record.avif_srcset = srcsets.get('AVIF', '')
+
+
+def _upload_photo(record, photo, suffix):
+    """
+    Make the thumbnail and resized derivatives of the given photo file and
+    upload them all to S3, along with the original.
+
+    Photos are stored under a hash of their contents, so one that has already
+    been uploaded is reused rather than being processed again.
+    """
+    suffix = suffix.lower()
+    digest = _photo_digest(photo)
+    if _find_photo(record, digest, suffix):
+        return
     try:
-        thumb = Image.open(photo_tmp_file)
-        thumb = _fix_exif_transpose(thumb)
-        thumb.thumbnail(thumbnail_size)
-        thumb.save(thumb_tmp_file)
+        with _timed('photo'):
+            derivatives, metadata = _make_derivatives(photo, digest, suffix)
     except Exception as e:
         if app.debug:
             raise
         raise FormError('Unable to process photo') from e
+    _set_srcsets(record, digest, metadata)
+    photo.seek(0)
     try:
-        s3.upload_file(photo_tmp_file,
-                       photo_bucket_name,
-                       record.photo_filename,
-                       ExtraArgs={'ContentType': content_type})
-        s3.upload_file(thumb_tmp_file,
-                       photo_bucket_name,
-                       record.thumb_filename,
-                       ExtraArgs={'ContentType': content_type})
+        with _timed('upload'):
+            with ThreadPoolExecutor(max_workers=len(derivatives)) as executor:
+                futures = [
+                    _submit(executor, s3.upload_fileobj, fileobj,
+                            photo_bucket_name, key, ExtraArgs={
+                                'ContentType': content_type,
+                                'CacheControl': photo_cache_control,
+                            })
+                    for fileobj, key, content_type in derivatives
+                ]
+                for future in futures:
+                    future.result()
+            # The original goes last, so that once it exists (which is what
+            # _find_photo checks for) all of its derivatives do too.
+            s3.upload_fileobj(photo, photo_bucket_name, f'{digest}{suffix}',
+                              ExtraArgs={
+                                  'ContentType':
+                                      mimetypes.guess_type(record.photo)[0],
+                                  'CacheControl': photo_cache_control,
+                                  'Metadata': metadata,
+                              })
     except ClientError as e:
         if app.debug:
             raise
         raise FormError('Unable to upload photo') from e
 
 
-def _cleanup_photos(record):
-    Path(f'/tmp/{record.photo_filename}').unlink()
-    Path(f'/tmp/{record.thumb_filename}').unlink()
+def _make_derivatives(photo, digest, suffix):
+    """
+    Make the thumbnail and resized copies of the photo, in its own format as
+    well as the more compact modern formats.
 
+    Returns the derivatives to upload as (file, key, content type) tuples,
+    and the metadata to store on the original listing the widths and formats
+    they were made in, for building srcsets.
+    """
+    from PIL import features, Image
+    image = Image.open(photo)
+    image_format = image.format
+    widths = sorted({width for width in photo_widths
+                     if width < max(image.size)} or {min(photo_widths)},
+                    reverse=True)
+    # For JPEGs, this has the decoder scale the image down as it decodes it,
+    # rather than decoding the full resolution image only to shrink it.
+    image.draft('RGB', (widths[0], widths[0]))
+    image = _fix_exif_transpose(image)
+    image.load()
+    formats = [(image_format, suffix)]
+    formats += [(fmt, fmt_suffix) for fmt, fmt_suffix in photo_formats
+                if fmt != image_format and features.check(fmt.lower())]
+    derivatives = []
+    thumb = image.copy()
+    thumb.thumbnail(thumbnail_size)
+    derivatives.append((_encode_photo(thumb, image_format),
+                        f'{digest}-thumb{suffix}',
+                        Image.MIME.get(image_format)))
+    sizes = []
+    for width in widths:
+        # Each size is scaled down from the last, which is quicker than
+        # scaling from the full size photo every time.
+        image.thumbnail((width, width))
+        sizes.append(f'{width}:{image.width}')
+        for fmt, fmt_suffix in formats:
+            derivatives.append((_encode_photo(image, fmt),
+                                f'{digest}-{width}w{fmt_suffix}',
+                                Image.MIME.get(fmt)))
+    # S3 metadata values have to be strings.
+    metadata = {
+        'widths': ' '.join(sizes),
+        'formats': ' '.join(f'{fmt}:{fmt_suffix}'
+                            for fmt, fmt_suffix in formats),
+    }
+    return derivatives, metadata
 
-def _verify_token():
+
+def _encode_photo(image, fmt):
+    # Only the pixels are carried over, so the EXIF data (which can include
+    # the location the photo was taken) is stripped.
+    options = photo_encode_options.get(fmt, {})
+    if fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    encoded = BytesIO()
+    image.save(encoded, format=fmt, **options)
+    encoded.seek(0)
+    return encoded
+
+
+class SnapshotError(Exception):
+    pass
+
+
+@app.cli.command('export-snapshot')
+def export_snapshot():
+    """Export the moderated records and public pages to S3."""
+    try:
+        manifest, uploaded = _export_snapshot()
+    except SnapshotError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Exported data version {manifest["version"]}: '
+               f'{len(uploaded)} of {len(manifest["files"])} files changed')
+
+
+# Exports in 'thread' mode run one at a time, and writes made while one is
+# waiting to start are picked up by it rather than queueing another.
+_snapshot_executor = ThreadPoolExecutor(max_workers=1)
+_snapshot_lock = threading.Lock()
+_snapshot_queued = False
+
+
+def _schedule_snapshot():
+    global _snapshot_queued
+    if snapshot_export == 'sync':
+        _run_snapshot_export()
+    elif snapshot_export == 'thread':
+        with _snapshot_lock:
+            if _snapshot_queued:
+                return
+            _snapshot_queued = True
+        _snapshot_executor.submit(_run_snapshot_export)
+
+
+def _run_snapshot_export():
+    global _snapshot_queued
+    with _snapshot_lock:
+        _snapshot_queued = False
+    # The write has already been made, so a failed export is only logged; the
+    # next write or export-snapshot will catch up.
+    try:
+        with app.app_context():
+            _export_snapshot()
+    except Exception:
+        app.logger.exception('Failed to export snapshot')
+
+
+def _export_snapshot():
+    """
+    Export a snapshot of the moderated records, with their search index, and
+    the public pages rendered from them to S3.
+
+    Every file is listed with a hash of its contents in a manifest, which is
+    uploaded last.  Only files that differ from the last export's manifest
+    are uploaded, and any it listed that are no longer needed are deleted.
+    Returns the new manifest and the keys uploaded.
+    """
+    if not snapshot_search_url:
+        # The pages' search form would post back to the page itself, which
+        # S3 serves without searching.
+        raise SnapshotError('SNAPSHOT_SEARCH_URL is not set, so searches '
+                            'from the exported pages would do nothing')
+    version = _data_version() if _use_dynamodb() else None
+    records = sorted((record for record
+                      in _load_data(fields=Record.listing_fields)
+                      if record.moderated),
+                     key=itemgetter('name', 'id'))
+    page_cache_control = (f'public, max-age={page_max_age}, '
+                          f'stale-while-revalidate='
+                          f'{page_stale_while_revalidate}')
+    files = {}
+
+    data = json.dumps(_snapshot_data(records), sort_keys=True,
+                      separators=(',', ':')).encode('utf8')
+    data_digest = sha256(data).hexdigest()
+    # The data is stored under its hash, so it can be cached for good, and
+    # the manifest says which one is current.
+    data_key = f'{snapshot_prefix}data/records-{data_digest[:32]}.json.gz'
+    files[data_key] = (data_digest, gzip.compress(data, mtime=0), {
+        'ContentType': 'application/json',
+        'ContentEncoding': 'gzip',
+        'CacheControl': photo_cache_control,
+    })
+
+    pages = {f'{snapshot_prefix}index.html': ('', [])}
+    for record in records:
+        slug = re.sub(r'[^a-z0-9]+', '-', _index_key(record.venue)).strip('-')
+        if slug:
+            key = f'{snapshot_prefix}venues/{slug}.html'
+            pages.setdefault(key, (' '.join(record.venue.split()), []))
+            pages[key][1].append(record)
+    # Only the front page has random picks, so that a venue's page only
+    # changes when its servers do.  They are seeded from the data, so the page
+    # only changes when the records do too.
+    picks = random.Random(data_digest).sample(records, min(4, len(records)))
+    for key, (search, search_results) in pages.items():
+        random_results = [] if search else picks
+        body = _render_index(search, search_results, random_results,
+                             search_url=snapshot_search_url).encode('utf8')
+        files[key] = (sha256(body).hexdigest(), body, {
+            'ContentType': 'text/html; charset=utf-8',
+            'CacheControl': page_cache_control,
+        })
+
+    previous = _snapshot_manifest() or {'files': {}}
+    uploads = [(key, body, extra_args)
+               for key, (digest, body, extra_args) in files.items()
+               if previous['files'].get(key) != digest]
+    if not uploads and files.keys() == previous['files'].keys():
+        # Nothing has changed, so the last manifest still stands.
+        return previous, []
+    if uploads:
+        with _timed('upload'), ThreadPoolExecutor(
+                max_workers=min(len(uploads), import_workers)) as executor:
+            futures = [
+                _submit(executor, s3.upload_fileobj, BytesIO(body),
+                        snapshot_bucket_name, key, ExtraArgs=extra_args)
+                for key, body, extra_args in uploads
+            ]
+            for future in futures:
+                future.result()
+    manifest = {
+        'format': snapshot_format,
+        'version': version,
+        'generated': datetime.now(timezone.utc).isoformat(),
+        'data': data_key,
+        'files': {key: digest for key, (digest, body, extra_args)
+                  in files.items()},
+    }
+    s3.upload_fileobj(BytesIO(json.dumps(manifest, indent=1).encode('utf8')),
+                      snapshot_bucket_name, f'{snapshot_prefix}manifest.json',
+                      ExtraArgs={
+                          'ContentType': 'application/json',
+                          'CacheControl': 'no-cache',
+                      })
+    for key in previous['files'].keys() - files.keys():
+        s3.delete_object(Bucket=snapshot_bucket_name, Key=key)
+    return manifest, [key for key, body, extra_args in uploads]
+
+
+def _snapshot_manifest():
+    try:
+        result = s3.get_object(Bucket=snapshot_bucket_name,
+                               Key=f'{snapshot_prefix}manifest.json')
+    except ClientError as e:
+        code = e.response.get('Error', {}).get('Code')
+        if code in ('404', 'NoSuchKey'):
+            return None
+        raise
+    manifest = json.loads(result['Body'].read())
+    if manifest.get('format') != snapshot_format:
+        # Everything is exported again in the new format.
+        return None
+    return manifest
+
+
+def _snapshot_data(records):
+    """
+    The exported records, stored by column rather than by record, which
+    takes much less space for the same field names repeated on every record.
+
+    The search index is included, so the records can be searched without
+    building it again; its record numbers are positions in the columns.
+    """
+    # Only moderated records are exported, so that is left out.
+    fields = [field for field in Record.listing_fields
+              if field != 'moderated']
+    index = SearchIndex(records)
+    return {
+        'format': snapshot_format,
+        'count': len(index.records),
+        'columns': {field: [record[field] for record in index.records]
+                    for field in fields},
+        'search': index.as_dict(),
+    }
+
+
+def _api_int(name, default):
+    try:
+        value = int(request.args.get(name, default))
+    except ValueError:
+        abort(400)
+    if value < 1:
+        abort(400)
+    return min(value, api_max_limit)
+
+
+def _api_fields(allowed):
+    """
+    Get the fields requested with ?fields=, limited to those allowed.
+
+    The ID is always included so that results can be told apart.
+    """
+    if 'fields' not in request.args:
+        return tuple(allowed)
+    fields = [field.strip() for field in request.args['fields'].split(',')
+              if field.strip()]
+    if any(field not in allowed for field in fields):
+        abort(400)
+    return ('id',) + tuple(field for field in fields if field != 'id')
+
+
+def _api_page(results, fields, public=False):
+    """
+    Respond with one page of results, which must be sorted by name and ID.
+
+    The cursor for the next page identifies the last result of this one, so
+    paging stays consistent even if records are added or removed in between.
+    """
+    limit = _api_int('limit', api_default_limit)
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            after = tuple(json.loads(urlsafe_b64decode(cursor.encode())))
+        except (ValueError, TypeError):
+            abort(400)
+        if len(after) != 2 or not all(isinstance(v, str) for v in after):
+            abort(400)
+        results = [record for record in results
+                   if (record.name, record.id) > after]
+    page = results[:limit]
+    next_cursor = None
+    if len(results) > limit:
+        next_cursor = urlsafe_b64encode(
+            json.dumps([page[-1].name, page[-1].id]).encode()).decode()
+    response = _api_response({
+        'results': [_api_record(record, fields) for record in page],
+        'next': next_cursor,
+    })
+    if public:
+        response.cache_control.public = True
+        response.cache_control.max_age = page_max_age
+        response.add_etag()
+        response = response.make_conditional(request)
+    return response
+
+
+def _api_record(record, fields):
+    return {field: record[field] for field in fields}
+
+
+def _api_response(payload):
+    body = json.dumps(payload, separators=(',', ':')).encode('utf8')
+    response = make_response(body)
+    response.mimetype = 'application/json'
+    response.vary.add('Accept-Encoding')
+    response.vary.add('Accept')
+    # Compressed responses are binary, which API Gateway only decodes from
+    # serverless-wsgi's base64 when the first type accepted is one of its
+    # binary types (application/json), rather than e.g. a browser's */*.
+    first_accepted = request.headers.get('Accept', '').split(',')[0]
+    if len(body) < api_compress_min_size or \
+            first_accepted.split(';')[0].strip() != 'application/json':
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(body))
+        response.content_encoding = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(body))
+        response.content_encoding = 'gzip'
+    return response
+
+
+def _wants_json():
+    return request.accept_mimetypes.best_match(
+        ['text/html', 'application/json']) == 'application/json'
+
+
+def _has_token():
     request_token = request.args.get('token', request.form.get('token', ''))
-    if not request_token or not admin_token or request_token != admin_token:
+    return bool(request_token and admin_token and request_token == admin_token)
+
+
+def _verify_token():
+    if not _has_token():
         abort(401)
 
 
@@ -486,6 +2668,7 @@ def _fix_exif_transpose(image):
         As per CIPA DC-008-2012, the orientation field contains an integer,
         1 through 8. Other values are reserved.
     """
+    from PIL import Image
 
     exif_orientation_tag = 0x0112
     exif_transpose_sequences = [                   # Val  0th row  0th col